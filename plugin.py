@@ -13,27 +13,42 @@
             </options>
         </param>
         <param field="Mode5" label="Log File" width="300px" default="/var/log/twcmaster.log"/>
+        <param field="Mode6" label="TWC phases (id:phases,...)" width="300px" default=""/>
     </params>
 </plugin>
 """
 
 import Domoticz
 import twcmaster
+import twcseries
+import twcsessions
+import time
 import logging
-import binascii
 import statistics
 
 # RS485 connection
 SerialConn = None
+STATEFILE = "twcstate.bin"  # twcmaster state in the plugin home folder, for resuming charging after a restart
+series = None               # power and amps samples per TWC, files twc-<id>.bin in the plugin home folder
+sessions = None             # charging sessions per TWC, files twcsessions.bin and twcsessions.open in the plugin home folder
 loglevel = logging.INFO
 
 # last network current for average of last 10 seconds
 networkCurrentList = []
 networkCurrentCount = 10
 
+# device updates: only changed values are written to Domoticz, unchanged values every DEVICEREFRESH seconds
+DEVICEREFRESH = 300         # seconds between updates of unchanged devices
+AMPSDEADBAND = 0.1          # min change in amps for updating current devices
+POWERDEADBAND = 10.0        # min change in watts or Wh for updating kWh devices
+deviceValues = {}           # last values and update time per unit
+
+# send timer: queued messages are released from onMessage and onHeartbeat, the connection is only used on the plugin thread
+sendTimerFunc = None        # function releasing the next queued message, None: no message waiting
+
 # start plugin: set config, devices en connect serial connection
 def onStart():
-    global loglevel
+    global loglevel, series, sessions
 
     Domoticz.Log("Start TWC plugin")
 
@@ -43,9 +58,25 @@ def onStart():
         loglevel = logging.DEBUG
     logfile = Parameters["Mode5"]
     twcmaster.setConfig(float(Parameters["Mode1"]), float(Parameters["Mode2"]), float(Parameters["Mode3"]), loglevel, logfile)
+    setTWCPhases(Parameters["Mode6"])
+
+    # resume the TWCs of the last run
+    twcmaster.setStateFile(Parameters["HomeFolder"] + STATEFILE)
+    twcmaster.loadState()
+
+    # sample power and amps per TWC every heartbeat
+    series = twcseries.SeriesStore(Parameters["HomeFolder"])
+    twcmaster.setSeries(series)
 
-    # set sendData method
+    # charging sessions, the sessions open at the last stop continue with the TWCs of the last run
+    sessions = twcsessions.SessionTracker(twcsessions.SessionStore(Parameters["HomeFolder"] + twcsessions.SESSIONFILE),
+                                          Parameters["HomeFolder"] + twcsessions.OPENSESSIONFILE)
+    sessions.load(time.time())
+    twcmaster.setSessions(sessions)
+
+    # set sendData method, queued messages are released by the plugin callbacks instead of timer threads
     twcmaster.setSendDataCallback(sendData)
+    twcmaster.setSendTimerCallback(setSendTimer)
 
     # add devices
     if (1 not in Devices):
@@ -64,6 +95,11 @@ def onStart():
         Domoticz.Device(Name="2 Power", Unit=12, TypeName="kWh").Create()
     if (13 not in Devices):
         Domoticz.Device(Name="3 Power", Unit=13, TypeName="kWh").Create()
+    if (6 not in Devices):
+        Domoticz.Device(Name="Solar", Unit=6, TypeName="Switch").Create()
+
+    # solar mode as switched before the restart
+    setSolarMode(Devices[6].nValue == 1)
 
     # connect to rs485 port
     SerialConn = Domoticz.Connection(Name="TWC", Transport="Serial", Address=Parameters["SerialPort"], Baud=9600)
@@ -76,6 +112,19 @@ def onStart():
 # stop plugin
 def onStop():
     Domoticz.Log("onStop called")
+    # cancel pending messages, Domoticz waits for running threads on stop
+    twcmaster.stopSending()
+    twcmaster.saveState()
+    twcmaster.setSeries(None)
+    if series:
+        series.close()
+    twcmaster.setSessions(None)
+    # open sessions are saved, they continue after a restart
+    if sessions:
+        sessions.close(time.time())
+    # frames are traced in a ring buffer, write them to the log file when debugging
+    if (loglevel == logging.DEBUG):
+        twcmaster.dumpFrameTrace("stop")
 
 # connected?
 def onConnect(Connection, Status, Description):
@@ -89,16 +138,15 @@ def onConnect(Connection, Status, Description):
 
 # message received from twc
 def onMessage(Connection, Data):
-    msg = bytearray([])
-    for b in range(len(Data)):
-        msg.append(Data[b])
-    if (loglevel == logging.DEBUG):
-        Domoticz.Log("Recv:" + str(binascii.hexlify(msg)))
-    twcmaster.dataReceived(msg)
+    twcmaster.dataReceived(Data)
+    # the slave answered: handle its messages now, the bus is free for the next queued message
+    twcmaster.handleReceived()
+    releaseSendSlot()
 
 # command from domitics
 # device "TWC - Network current" -> set total current in use and the voltage(s)
 # device "TWC - Total charge" -> set scheduled max current
+# device "TWC - Solar" -> solar mode on/off
 def onCommand(Unit, Command, Level, Hue):
     global networkCurrent
     Domoticz.Log("onCommand called for Unit " + str(Unit) + ": Parameter '" + str(Command) + "', Level: " + str(Level))
@@ -123,11 +171,16 @@ def onCommand(Unit, Command, Level, Hue):
             networkCurrentList.append(twcmaster.getTotalAmps())
             if len(networkCurrentList) > networkCurrentCount:
                 networkCurrentList.pop(0)
-            Devices[1].Update(nValue=0, sValue=str(round(statistics.mean(networkCurrentList), 2)))
+            updateDevice(1, [statistics.mean(networkCurrentList)], 2, AMPSDEADBAND)
     if (Unit == 2):
         # set max charge current
         amps = float(Command)
         twcmaster.setScheduledMaxAmps(amps)
+    if (Unit == 6):
+        # charge with the power exported to the grid
+        solar = (Command == "On")
+        setSolarMode(solar)
+        Devices[6].Update(nValue=1 if solar else 0, sValue="On" if solar else "Off")
 
 # plugin notification
 def onNotification(Name, Subject, Text, Status, Priority, Sound, ImageFile):
@@ -141,36 +194,24 @@ def onDisconnect(Connection):
 def onHeartbeat():
     # call twcmaster heartbeat
     twcmaster.handleHeartBeat()
+    releaseSendSlot()
 
-    # get twc power
-    twcpow = twcmaster.getTWCsPower()
-    twckwh = twcmaster.getTWCsTotalKwh()
-    twcPowerValues = []
-    for twcid, power in sorted(twcpow.items()):
-        kwh = twckwh[twcid]
+    # get all twc data, sorted by twc id: twcId, actualAmps, setAmps, power, totalKwh per twc
+    twcs = twcmaster.getTWCsSnapshot()
+    fields = twcmaster.SNAPSHOTFIELDS
+
+    # update changed devices
+    now = time.time()
+    updateDevice(2, [twcmaster.getTotalChargingAmps()], 2, AMPSDEADBAND, now)
+    updateDevice(3, [twcmaster.getTWCTotalAvailableAmps()], 2, AMPSDEADBAND, now)
+    updateDevice(4, twcs[1:3 * fields:fields], 2, AMPSDEADBAND, now, 3)
+    updateDevice(5, twcs[2:3 * fields:fields], 2, AMPSDEADBAND, now, 3)
+
+    # kWh devices: power;energy in Wh, not updated when the TWC has not send its kwh yet
+    for unit, i in zip((11, 12, 13), range(0, len(twcs), fields)):
+        kwh = twcs[i + 4]
         if (kwh > 0):
-            twcPowerValues.append(str(round(power, 0)) + ";" + str(round(kwh * 1000, 0)))
-        else:
-            twcPowerValues.append("0;0")
-    for _ in range(len(twcPowerValues), 3):
-        twcPowerValues.append("0;0")
-
-    # update devices
-    if (2 in Devices):
-        Devices[2].Update(nValue=0, sValue=str(round(twcmaster.getTotalChargingAmps(), 2)))
-    if (3 in Devices):
-        Devices[3].Update(nValue=0, sValue=str(round(twcmaster.getTWCTotalAvailableAmps(), 2)))
-    if (4 in Devices):
-        setDeviceValues(Devices[4], twcmaster.getTWCsActualAmps().items(), 3, 2)
-    if (5 in Devices):
-        setDeviceValues(Devices[5], twcmaster.getTWCsSetAmps().items(), 3, 2)
-
-    if ((11 in Devices) and (twcPowerValues[0] != "0;0")):
-        Devices[11].Update(nValue=0, sValue=twcPowerValues[0])
-    if ((12 in Devices) and (twcPowerValues[1] != "0;0")):
-        Devices[12].Update(nValue=0, sValue=twcPowerValues[1])
-    if ((13 in Devices) and (twcPowerValues[2] != "0;0")):
-        Devices[13].Update(nValue=0, sValue=twcPowerValues[2])
+            updateDevice(unit, [twcs[i + 3], kwh * 1000], 0, POWERDEADBAND, now)
 
     # reconnect?
     if (SerialConn):
@@ -182,22 +223,60 @@ def onHeartbeat():
 Generic helper functions
 '''
 
+# set phases per TWC: "id:phases,...", id in hex, phases 1..3, e.g. "1234:1,5678:123", TWCs not listed use all phases
+def setTWCPhases(config):
+    for item in config.replace(";", ",").split(","):
+        if (item.strip() == ""):
+            continue
+        try:
+            twcId, phases = item.split(":")
+            twcmaster.setTWCPhases(int(twcId, 16), [int(p) - 1 for p in phases.strip()])
+        except ValueError:
+            Domoticz.Error("Invalid TWC phases: " + item)
+
+# solar mode: the current for the TWC's follows the power exported to the grid, P1 power must be signed
+def setSolarMode(solar):
+    twcmaster.setSolarMode(twcmaster.SolarController() if solar else None)
+
+# send timer callback of twcmaster: keep func, it is called from the plugin callbacks
+def setSendTimer(delay, func):
+    global sendTimerFunc
+    sendTimerFunc = func
+
+# release the next queued message, twcmaster waits for the end of the bus slot and sets the timer again
+def releaseSendSlot():
+    global sendTimerFunc
+    if sendTimerFunc:
+        func = sendTimerFunc
+        sendTimerFunc = None
+        func()
+
 # send message to slave TWC(s)
 def sendData(data):
     if (SerialConn):
         SerialConn.Send(data)
-        if (loglevel == logging.DEBUG):
-            Domoticz.Log("Send:" + str(binascii.hexlify(data)))
-
-# set current device values
-def setDeviceValues(device, values, count, decimals):
-    s = ""
-    for _, v in sorted(values):
-        s = s + str(round(v, decimals)) + ";"
-    for _ in range(len(values), count):
-        s = s + "null;"
-    s = s.rstrip(';')
-    device.Update(nValue=0, sValue=s)
+
+# update device with values separated by ";", missing values up to count are shown as null
+# the device is only updated when a value changed more than deadband, or after DEVICEREFRESH seconds
+def updateDevice(unit, values, decimals, deadband, now = None, count = 0):
+    if (unit not in Devices):
+        return
+    if now == None:
+        now = time.time()
+    values = [round(v, decimals) for v in values]
+    last = deviceValues.get(unit)
+    if last and (now - last[1] < DEVICEREFRESH) and (len(last[0]) == len(values)):
+        changed = False
+        for v, lastValue in zip(values, last[0]):
+            if abs(v - lastValue) > deadband:
+                changed = True
+                break
+        if not changed:
+            return
+    deviceValues[unit] = (values, now)
+    s = [str(v) for v in values]
+    s.extend("null" for _ in range(len(values), count))
+    Devices[unit].Update(nValue=0, sValue=";".join(s))
 
 # dump config
 def DumpConfigToLog():
@@ -5,6 +5,10 @@
 local powerDevice1 = "Usage L1"
 local powerDevice2 = "Usage L2"
 local powerDevice3 = "Usage L3"
+-- power returned to the grid (solar), subtracted from usage: negative power is export
+local deliveryDevice1 = "Delivery L1"
+local deliveryDevice2 = "Delivery L2"
+local deliveryDevice3 = "Delivery L3"
 local voltsDevice1 = "Voltage L1"
 local voltsDevice2 = "Voltage L2"
 local voltsDevice3 = "Voltage L3"
@@ -15,12 +19,13 @@ commandArray = {}
 if (devicechanged) then
     for deviceName,deviceValue in pairs(devicechanged) do
         if (deviceName == powerDevice1) then
-            p2 = otherdevices[powerDevice2]
-            p3 = otherdevices[powerDevice3]
+            p1 = (tonumber(deviceValue) or 0) - (tonumber(otherdevices[deliveryDevice1]) or 0)
+            p2 = (tonumber(otherdevices[powerDevice2]) or 0) - (tonumber(otherdevices[deliveryDevice2]) or 0)
+            p3 = (tonumber(otherdevices[powerDevice3]) or 0) - (tonumber(otherdevices[deliveryDevice3]) or 0)
             v1 = otherdevices[voltsDevice1]
             v2 = otherdevices[voltsDevice2]
             v3 = otherdevices[voltsDevice3]
-            commandArray['TWC - Network current'] = tostring(deviceValue)..";"..tostring(p2 or 0)..";"..tostring(p3 or 0)..";"..tostring(v1 or 0)..";"..tostring(v2 or 0)..";"..tostring(v3 or 0)
+            commandArray['TWC - Network current'] = tostring(p1)..";"..tostring(p2)..";"..tostring(p3)..";"..tostring(v1 or 0)..";"..tostring(v2 or 0)..";"..tostring(v3 or 0)
         end
     end
 end
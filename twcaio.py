@@ -0,0 +1,122 @@
+#
+# TWC asyncio
+# Run a TWCMaster on a serial port with asyncio, without Domoticz
+# received messages are handled as soon as they arrive, the heartbeat and the send slots use asyncio timers
+# needs pyserial-asyncio: pip3 install pyserial-asyncio
+#
+import sys
+import asyncio
+import logging
+import twcmaster
+
+try:
+    import serial_asyncio
+except ImportError:
+    serial_asyncio = None
+
+HEARTBEATINTERVAL = 1.0     # seconds between master heartbeats (handleHeartBeat)
+
+
+# asyncio protocol for the RS485 serial connection of one master
+class TWCProtocol(asyncio.Protocol):
+    def __init__(self, master, loop):
+        self.master = master
+        self.loop = loop
+        self.transport = None
+        self.heartbeatHandle = None
+        self.closed = loop.create_future()
+
+    # serial port opened: send with the transport and release send slots with loop timers
+    def connection_made(self, transport):
+        logging.info("Serial connection opened")
+        self.transport = transport
+        self.master.setSendDataCallback(transport.write)
+        self.master.setSendTimerCallback(self.loop.call_later)
+        self.heartbeat()
+
+    # data received: handle complete messages now instead of waiting for the next heartbeat
+    def data_received(self, data):
+        self.master.dataReceived(data)
+        count = len(self.master.twcs)
+        if self.master.handleReceived() and (len(self.master.twcs) > count):
+            # new slave: send heartbeats now
+            self.master.update()
+        # the slave answered, check for queued messages
+        self.master.processSendQueue()
+
+    # serial port closed
+    def connection_lost(self, exc):
+        logging.info("Serial connection closed: %s", exc)
+        if self.heartbeatHandle:
+            self.heartbeatHandle.cancel()
+            self.heartbeatHandle = None
+        self.master.stopSending()
+        self.master.setSendDataCallback(None)
+        if not self.closed.done():
+            self.closed.set_result(exc)
+
+    # master heartbeat every HEARTBEATINTERVAL seconds
+    def heartbeat(self):
+        self.heartbeatHandle = self.loop.call_later(HEARTBEATINTERVAL, self.heartbeat)
+        try:
+            self.master.handleHeartBeat()
+        except Exception:
+            logging.exception("Heartbeat failed")
+
+
+# set power and volts from a line "p1;p2;p3[;v1;v2;v3]", watts and volts per phase as send to the Domoticz network current device
+def setPowerLine(master, line):
+    try:
+        values = [float(v) for v in line.split(";")]
+    except ValueError:
+        logging.error("Invalid power line: %s", line.strip())
+        return
+    if len(values) < 3:
+        logging.error("Invalid power line: %s", line.strip())
+        return
+    if len(values) >= 6:
+        master.setActualVolts(values[3:6])
+    master.setActualPower(values[0:3])
+
+
+# power feed: read power lines from stdin until end of file
+async def readPowerFromStdin(master):
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+    while True:
+        line = await reader.readline()
+        if not line:
+            logging.warn("End of power input, master goes to save mode")
+            break
+        setPowerLine(master, line.decode())
+
+
+# open the serial port and run the master until the connection is lost
+# power: coroutine function(master) feeding the actual power with master.setActualPower, run while the master runs,
+# without power the master stays in save mode at TWCMINAMPS
+async def run(port, master = None, baudrate = 9600, power = None):
+    if serial_asyncio == None:
+        raise ImportError("twcaio needs pyserial-asyncio: pip3 install pyserial-asyncio")
+    if master == None:
+        master = twcmaster.master
+    loop = asyncio.get_running_loop()
+    _, protocol = await serial_asyncio.create_serial_connection(loop, lambda: TWCProtocol(master, loop), port, baudrate=baudrate)
+    feed = loop.create_task(power(master)) if power else None
+    try:
+        return await protocol.closed
+    finally:
+        if feed:
+            feed.cancel()
+
+
+# run: python3 twcaio.py port [max network current] [max current all TWC's] [max current per TWC]
+# the power is read from stdin, one line per P1 reading: p1;p2;p3;v1;v2;v3
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("usage: python3 twcaio.py port [totalmax] [twctotalmax] [twcmax]")
+        sys.exit(1)
+    amps = [float(a) for a in sys.argv[2:5]]
+    amps += [twcmaster.TotalMaxAmps, twcmaster.TWCsTotalMaxAmps, twcmaster.TWCMaxAmps][len(amps):]
+    twcmaster.setConfig(amps[0], amps[1], amps[2], logging.INFO, "")
+    asyncio.run(run(sys.argv[1], power = readPowerFromStdin))
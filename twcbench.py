@@ -0,0 +1,425 @@
+#
+# TWC benchmarks
+# Time the twcmaster hot paths and compare with a baseline, fails when a hot path is slower than the threshold
+#   python3 twcbench.py --save       save the baseline (twcbench.json), run on the controller itself
+#   python3 twcbench.py              compare with the baseline, exit code 1 on a regression
+#   python3 twcbench.py --compare    compare with the original implementations and run the fleet simulations
+#   python3 twcbench.py --check      only check the codec and decoder against the original implementations, exit code 1 on a mismatch
+#
+import sys
+import json
+import types
+import random
+import timeit
+import logging
+import argparse
+import twcmaster
+import twcsim
+
+BASELINEFILE = "twcbench.json"
+THRESHOLD = 1.5             # fail when a benchmark takes longer than THRESHOLD * baseline
+
+
+# build a frame as send by a slave: c0 escaped(msg + checksum) c0 fe
+def makeFrame(msg):
+    msgdata = bytearray(msg)
+    msgdata.append(twcmaster.calcChecksum(msgdata, 1, len(msgdata)))
+    data = bytearray([0xc0])
+    data.extend(twcmaster.escapeData(msgdata))
+    data.extend(bytearray([0xc0, 0xfe]))
+    return data
+
+
+# capture with heartbeats and kwh/volts messages from slaves mixed with line noise
+def makeCapture(size, seed=1):
+    rnd = random.Random(seed)
+    data = bytearray()
+    while len(data) < size:
+        sender = rnd.choice([0x1234, 0xc0db, 0xabcd])
+        if rnd.random() < 0.8:
+            msg = [0xfd, 0xe0, sender >> 8, sender & 0xff, 0x88, 0x88, 1, 0x06, 0x40, 0x05, 0xdc, 0, 0, 0, 0]
+        else:
+            msg = [0xfd, 0xeb, sender >> 8, sender & 0xff, 0, 0, 0x0c, 0xdb, 0, 230, 0, 231, 0, 229, 0]
+        data.extend(makeFrame(msg))
+        # line noise
+        if rnd.random() < 0.1:
+            data.extend(bytes(rnd.randrange(256) for _ in range(rnd.randrange(1, 20))))
+    return data
+
+
+# original recvMsg implementation, for comparing
+def recvMsgListPop(dataIn):
+    start = dataIn.find(b"\xc0")
+    if start < 0:
+        return None
+    end = dataIn.find(b"\xc0", start + 1)
+    if (end-start == 1):
+        start = end
+        end = dataIn.find(b"\xc0", start + 1)
+    if end < 0:
+        return None
+    for _ in range(start+1):
+        dataIn.pop(0)
+    msg = bytearray([])
+    for _ in range(end-start-1):
+        msg.append(dataIn.pop(0))
+    return twcmaster.unescapeData(msg)
+
+
+# original escape/unescape/checksum implementations, for comparing
+def escapeDataLoop(msg):
+    data = bytearray([])
+    for b in msg:
+        if b == 0xc0:
+            data.append(0xdb)
+            data.append(0xdc)
+        elif b == 0xdb:
+            data.append(0xdb)
+            data.append(0xdd)
+        else:
+            data.append(b)
+    return data
+
+
+def unescapeDataLoop(msg):
+    data = bytearray([])
+    escfound = False
+    for b in msg:
+        if escfound:
+            if b == 0xdc:
+                data.append(0xc0)
+            elif b == 0xdd:
+                data.append(0xdb)
+            else:
+                data.append(b)
+            escfound = False
+        else:
+            if b == 0xdb:
+                escfound = True
+            else:
+                data.append(b)
+    return data
+
+
+def calcChecksumLoop(msg, start, end):
+    checksum = 0
+    for i in range(start, end):
+        checksum += msg[i]
+    return checksum & 0xFF
+
+
+def encodeFrameLoop(msg):
+    msgdata = bytearray(msg)
+    msgdata.extend(bytearray([calcChecksumLoop(msgdata, 1, len(msgdata))]))
+    data = bytearray([0xc0])
+    data.extend(escapeDataLoop(msgdata))
+    data.extend(bytearray([0xc0,0xfe]))
+    return data
+
+
+# compare codec with the original implementations on random messages, biased to escape bytes
+# returns True when everything matches, mismatches are printed
+def checkCodec(count=20000, seed=1):
+    rnd = random.Random(seed)
+    alphabet = [0xc0, 0xdb, 0xdc, 0xdd, 0x00, 0xfe] + list(range(256))
+    mismatches = 0
+    for _ in range(count):
+        msg = bytes(rnd.choice(alphabet) for _ in range(rnd.randrange(0, 40)))
+        escaped = twcmaster.escapeData(msg)
+        checks = (
+            ("escapeData", escaped == escapeDataLoop(msg)),
+            ("escapeData c0", b"\xc0" not in escaped),
+            ("unescapeData round trip", twcmaster.unescapeData(escaped) == msg),
+            ("unescapeData", twcmaster.unescapeData(msg) == unescapeDataLoop(msg)),
+            ("calcChecksum", twcmaster.calcChecksum(msg, 1, len(msg)) == calcChecksumLoop(msg, 1, len(msg))),
+            ("encodeFrame", twcmaster.encodeFrame(msg) == encodeFrameLoop(msg)),
+        )
+        for name, ok in checks:
+            if not ok:
+                mismatches += 1
+                print("codec: %s mismatch for %s" % (name, msg.hex()))
+    if mismatches == 0:
+        print("codec: %d random messages match the original implementation" % count)
+
+    # decoder fed in random chunks returns the same frames as the original recvMsg
+    capture = makeCapture(20000, seed)
+    dataIn = bytearray(capture)
+    expected = []
+    msg = recvMsgListPop(dataIn)
+    while msg != None:
+        if msg:
+            expected.append(bytes(msg))
+        msg = recvMsgListPop(dataIn)
+    decoder = twcmaster.FrameDecoder(64)
+    frames = []
+    offset = 0
+    while offset < len(capture):
+        size = rnd.randrange(1, 200)
+        decoder.feed(memoryview(capture)[offset:offset + size])
+        offset += size
+        frames.extend(bytes(frame) for frame in decoder.frames())
+    if frames != expected:
+        mismatches += 1
+        print("decoder: %d frames, expected %d frames of the original implementation" % (len(frames), len(expected)))
+    else:
+        print("decoder: %d frames match the original implementation" % len(frames))
+    return mismatches == 0
+
+
+def benchCodec():
+    heartbeat = bytes([0xfb, 0xe0, 0x88, 0x88, 0xc0, 0xdb, 0x09, 0x06, 0x40, 0, 0, 0, 0, 0, 0, 0x8b])
+    plain = bytes([0xfd, 0xe0, 0x12, 0x34, 0x88, 0x88, 0x01, 0x06, 0x40, 0x05, 0x14, 0, 0, 0, 0, 0xc3])
+    escaped = twcmaster.escapeData(heartbeat)
+    tests = (
+        ("escapeData", lambda: escapeDataLoop(heartbeat), lambda: twcmaster.escapeData(heartbeat)),
+        ("unescapeData", lambda: unescapeDataLoop(escaped), lambda: twcmaster.unescapeData(escaped)),
+        ("unescape plain", lambda: unescapeDataLoop(plain), lambda: twcmaster.unescapeData(plain)),
+        ("calcChecksum", lambda: calcChecksumLoop(plain, 1, 14), lambda: twcmaster.calcChecksum(plain, 1, 14)),
+        ("encodeFrame", lambda: encodeFrameLoop(heartbeat), lambda: twcmaster.encodeFrame(heartbeat)),
+    )
+    print("codec per frame:")
+    for name, loop, codec in tests:
+        tloop = min(timeit.repeat(loop, number=10000, repeat=3)) / 10000
+        tcodec = min(timeit.repeat(codec, number=10000, repeat=3)) / 10000
+        print("    %-14s loop %6.2f us  codec %6.2f us" % (name, tloop * 1e6, tcodec * 1e6))
+
+
+# other devices amps history: list with pop(0) and max() against SlidingMax
+def benchHistory(windowSize, count=20000):
+    rnd = random.Random(1)
+    values = [rnd.random() * 25 for _ in range(count)]
+
+    def histList():
+        hist = []
+        for v in values:
+            hist.append(v)
+            if len(hist) > windowSize:
+                hist.pop(0)
+            max(hist)
+
+    def slidingMax():
+        hist = twcmaster.SlidingMax(windowSize)
+        for i, v in enumerate(values):
+            hist.push(v, i)
+            hist.max()
+
+    print("history window %5d:" % windowSize)
+    for name, func in (("list max", histList), ("SlidingMax", slidingMax)):
+        t = min(timeit.repeat(func, number=1, repeat=3)) / count
+        print("    %-14s %8.2f us/sample" % (name, t * 1e6))
+
+
+# simulated fleet: tick latency, bus throughput and convergence after the other load drops from 20 A to 4 A
+def benchFleet(count, seconds):
+    slaves = [twcsim.SimSlave(0x1000 + i, version=1 + (i % 2)) for i in range(count)]
+    step = seconds / 2
+    otherLoad = lambda t: [4600.0 if t < step else 920.0] * 3
+    sim = twcsim.Simulation(slaves, noiseRate=0.01, lossRate=0.01, otherLoad=otherLoad)
+    sim.master.setMaxSlaves(count)
+    sim.master.setConfig(25.0 + 16.0 * (count - 1), 16.0 * count, 16.0)
+    sim.master.setScheduledMaxAmps(16.0 * count)
+    t = timeit.default_timer()
+    sim.run(seconds)
+    t = timeit.default_timer() - t
+    ticks = sorted(sim.tickTimes)
+    converged = sim.convergenceTime(step)
+    print("fleet %2d slaves, %6.0f s simulated in %5.2f s: tick mean %6.1f us p99 %6.1f us, %4.1f frames/s, converged in %s s" % (
+        count, seconds, t, sum(ticks) / len(ticks) * 1e6, ticks[int(len(ticks) * 0.99)] * 1e6,
+        (sim.bus.framesFromMaster + sim.bus.framesToMaster) / seconds, "%.0f" % converged if converged != None else "-"))
+
+
+def benchRecvMsg(size):
+    capture = makeCapture(size)
+
+    def listPop():
+        dataIn = bytearray(capture)
+        count = 0
+        while recvMsgListPop(dataIn) != None:
+            count += 1
+        return count
+
+    def decoder():
+        decoder = twcmaster.FrameDecoder()
+        decoder.feed(capture)
+        count = 0
+        for _ in decoder.frames():
+            count += 1
+        return count
+
+    print("recvMsg %6d bytes: %d frames" % (size, decoder()))
+    for name, func in (("list pop", listPop), ("FrameDecoder", decoder)):
+        t = min(timeit.repeat(func, number=1, repeat=3))
+        print("    %-14s %8.2f ms" % (name, t * 1000))
+
+
+# seconds per call of func, best of repeat
+def measure(func, number, repeat = 5):
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number
+
+
+# message from slave as returned by recvMsg: msg + checksum
+def makeMsg(msg):
+    msg = bytearray(msg)
+    msg.append(twcmaster.calcChecksum(msg, 1, len(msg)))
+    return msg
+
+
+# simulated fleet of count linked and charging slaves
+def makeFleet(count):
+    slaves = [twcsim.SimSlave(0x1000 + i, version=1 + (i % 2)) for i in range(count)]
+    sim = twcsim.Simulation(slaves)
+    sim.master.setMaxSlaves(count)
+    sim.master.setConfig(25.0 + 16.0 * count, 16.0 * count, 16.0)
+    sim.master.setScheduledMaxAmps(16.0 * count)
+    sim.run(120)
+    return sim
+
+
+# Domoticz device for timing the plugin outside Domoticz
+class BenchDevice:
+    def __init__(self):
+        self.updates = 0
+        self.sValue = ""
+
+    def Update(self, nValue = 0, sValue = ""):
+        self.updates += 1
+        self.sValue = sValue
+
+
+# import plugin with a minimal Domoticz module when running outside Domoticz
+def loadPlugin():
+    if "Domoticz" not in sys.modules:
+        domoticz = types.ModuleType("Domoticz")
+        domoticz.Log = lambda msg: None
+        domoticz.Debug = lambda msg: None
+        domoticz.Error = lambda msg: None
+        sys.modules["Domoticz"] = domoticz
+    import plugin
+    plugin.Parameters = {}
+    plugin.Devices = dict((unit, BenchDevice()) for unit in (1, 2, 3, 4, 5, 11, 12, 13))
+    return plugin
+
+
+# the hot paths: returns {name: seconds per call}
+def runSuite():
+    results = {}
+
+    # receive buffer with a large backlog
+    capture = makeCapture(32000)
+    def recv():
+        decoder = twcmaster.FrameDecoder()
+        decoder.feed(capture)
+        for _ in decoder.frames():
+            pass
+    results["recvMsg_32k"] = measure(recv, 1)
+
+    # codec per frame
+    heartbeat = bytes([0xfb, 0xe0, 0x88, 0x88, 0xc0, 0xdb, 0x09, 0x06, 0x40, 0, 0, 0, 0, 0, 0, 0x8b])
+    escaped = twcmaster.escapeData(heartbeat)
+    results["escapeData"] = measure(lambda: twcmaster.escapeData(heartbeat), 10000)
+    results["unescapeData"] = measure(lambda: twcmaster.unescapeData(escaped), 10000)
+    results["encodeFrame"] = measure(lambda: twcmaster.encodeFrame(heartbeat), 10000)
+
+    # handleRecvMsg per message type, for a known slave
+    master = twcmaster.TWCMaster(clock=twcmaster.VirtualClock(1000.0))
+    linkready = makeMsg([0xfd, 0xe2, 0x12, 0x34, 0x77, 0x0c, 0x80, 0, 0, 0, 0, 0, 0, 0, 0])
+    master.handleRecvMsg(linkready)
+    heartbeat = makeMsg([0xfd, 0xe0, 0x12, 0x34, 0x88, 0x88, 1, 0x06, 0x40, 0x05, 0xdc, 0, 0, 0, 0])
+    kwhvolts = makeMsg([0xfd, 0xeb, 0x12, 0x34, 0, 0, 0x0c, 0xdb, 0, 230, 0, 231, 0, 229, 0])
+    results["handleRecvMsg_linkready"] = measure(lambda: master.handleRecvMsg(linkready), 10000)
+    results["handleRecvMsg_heartbeat"] = measure(lambda: master.handleRecvMsg(heartbeat), 10000)
+    results["handleRecvMsg_kwhvolts"] = measure(lambda: master.handleRecvMsg(kwhvolts), 10000)
+
+    # calcDesiredAmps with a full history window
+    for windowSize in (60, 9000):
+        master.setOtherAmpsHistory(windowSize)
+        rnd = random.Random(1)
+        def calc():
+            master.actualTotalPower = [rnd.random() * 5000.0, 0.0, 0.0]
+            master.calcDesiredAmps(1000.0)
+        for _ in range(windowSize):
+            calc()
+        results["calcDesiredAmps_h%d" % windowSize] = measure(calc, 1000)
+
+    # full tick with N slaves, median of the simulated ticks
+    for count in (3, 30):
+        sim = makeFleet(count)
+        sim.tickTimes = []
+        sim.run(600)
+        ticks = sorted(sim.tickTimes)
+        results["update_%dslaves" % count] = ticks[len(ticks) // 2]
+
+    # plugin.onHeartbeat device serialization
+    plugin = loadPlugin()
+    sim = makeFleet(3)
+    twcmaster.master = sim.master
+    results["onHeartbeat_3slaves"] = measure(plugin.onHeartbeat, 5000)
+    return results
+
+
+# compare results with baseline, returns names of the benchmarks slower than threshold * baseline
+def compareBaseline(results, baseline, threshold):
+    regressions = []
+    print("%-26s %12s %12s %7s" % ("benchmark", "baseline us", "actual us", "ratio"))
+    for name, seconds in sorted(results.items()):
+        base = baseline.get(name)
+        if base:
+            ratio = seconds / base
+            flag = ""
+            if ratio > threshold:
+                regressions.append(name)
+                flag = " REGRESSION"
+            print("%-26s %12.2f %12.2f %7.2f%s" % (name, base * 1e6, seconds * 1e6, ratio, flag))
+        else:
+            print("%-26s %12s %12.2f" % (name, "-", seconds * 1e6))
+    return regressions
+
+
+# compare with the original implementations and run the fleet simulations
+def runCompare():
+    checkCodec()
+    benchCodec()
+    for size in (2000, 8000, 32000):
+        benchRecvMsg(size)
+    for windowSize in (60, 900, 9000):
+        benchHistory(windowSize)
+    for count in (1, 3, 10, 30):
+        benchFleet(count, 3600)
+    # a day of charging in simulated time
+    benchFleet(3, 86400)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="TWC master benchmarks")
+    parser.add_argument("--save", action="store_true", help="save results as baseline")
+    parser.add_argument("--baseline", default=BASELINEFILE, help="baseline file (default: %(default)s)")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD, help="max ratio to baseline (default: %(default)s)")
+    parser.add_argument("--compare", action="store_true", help="compare with the original implementations")
+    parser.add_argument("--check", action="store_true", help="only check the codec and decoder, exit code 1 on a mismatch")
+    args = parser.parse_args()
+
+    # noise causes escape errors, do not time the logging
+    logging.disable(logging.CRITICAL)
+    if args.check:
+        sys.exit(0 if checkCodec() else 1)
+    if args.compare:
+        runCompare()
+        sys.exit(0)
+
+    results = runSuite()
+    if args.save:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        compareBaseline(results, {}, args.threshold)
+        print("baseline saved to %s" % args.baseline)
+        sys.exit(0)
+    try:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    except (IOError, ValueError) as e:
+        print("no baseline %s (%s), run with --save first" % (args.baseline, e))
+        baseline = {}
+    regressions = compareBaseline(results, baseline, args.threshold)
+    if regressions:
+        print("%d regression(s): %s" % (len(regressions), ", ".join(regressions)))
+        sys.exit(1)
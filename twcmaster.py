@@ -2,47 +2,67 @@
 # TCWMaster
 # Set the max current for the slave Tesla Wall Connector(s) based on total network power usage
 #
+import os
+import re
 import math
 import time
+import struct
 import logging
 import logging.handlers
 import binascii
+import threading
+import collections
+import heapq
+from array import array
 
 # Consts
 INCAMPSDELAY = 10           # delay before a twc can increase current
 DECAMPSDELAY = 0            # delay before a twc can decrease current
+RAMPMINDELAY = 1            # min delay before a twc can increase current again, when the car reached the last setting
+RAMPMARGIN = 1.0            # seconds added to the learned response time of the car, the P1 reading follows the car
+RAMPTIMEOUT = 30            # seconds a car may take to reach the set amps, a car that does not reach it limits itself
+RAMPTOLERANCE = 1.0         # amps below the set amps a car has reached it
+RAMPALPHA = 0.3             # weight of a new response time in the learned response time
 STARTCHARGETIME = 5         # delay 5 seconds after start charging
 TIMETOSAVEMODE = 10         # time before going to save mode when no actual total power has been received
 TIMETODELTWC = 30           # time before TWC is removed from list when it does not send heartbeats
-MSGSLEEP = 0.2              # wait after sending a message for slave to respond, preventing message collisions
+MSGSLEEP = 0.2              # bus slot after sending a message for slave to respond, preventing message collisions
 MAXSLAVES = 3               # max number of slaves
+MAXPHASES = 3               # max number of phases
+ALLPHASES = (0, 1, 2)       # phases of a three phase TWC
+SNAPSHOTFIELDS = 5          # values per TWC in snapshot: twcId, actualAmps, setAmps, power, totalKwh
 TWCMINAMPS = 6.0            # min current needed for charging
-
-# Config paramters
+KWHMAXSTEP = 100            # max kwh change between two kwh readings, a larger change is a counter reset
+STARTMARGIN = 1.0           # amps above TWCMINAMPS needed to start a stopped TWC (water filling allocator)
+RESTARTDELAY = 300          # seconds before a TWC stopped for lack of current is started again (water filling allocator)
+TAPERMARGIN = 2.0           # amps above the actual current for a TWC whose car uses less than set (water filling allocator)
+FORECASTTAU = 10.0          # time constant in seconds of the load forecast mean and variance
+FORECASTSIGMAS = 1.0        # load forecast: standard deviations above the mean
+FORECASTMARGIN = 1.0        # load forecast: safety margin in amps
+SOLARTARGET = 0.0           # solar mode: grid power setpoint in watts, negative: keep exporting
+SOLARKP = 0.5               # solar mode: proportional gain, amps per amp of surplus
+SOLARKI = 0.1               # solar mode: integral gain, amps per amp second of surplus
+SOLARBAND = 0.5             # solar mode: surplus in amps (+/-) that is not corrected, hysteresis band
+SOLARINTEGRALMAX = 3.0      # solar mode: max amps (+/-) of the integral term, anti-windup
+SOLARSTARTMARGIN = 1.0      # solar mode: amps above TWCMINAMPS needed to start charging
+SOLARDELAY = 30             # solar mode: seconds the surplus must be above start or below stop before starting or stopping
+SOLARINCAMPSDELAY = 2       # solar mode: delay before a twc can increase current
+STATESAVEINTERVAL = 10      # seconds between state saves, well below STATEMAXAGE so a crashed plugin can resume
+STATEMAXAGE = 60            # max age in seconds of a saved state for resuming without linkready
+TRACESIZE = 200             # frames kept in the frame trace
+TRACERATE = 20.0            # max frames per second added to the frame trace, 0: no limit
+TRACEDUMPINTERVAL = 60      # min seconds between frame trace dumps on errors
+
+# Config paramters, defaults for new masters
 TotalMaxAmps = 25.0         # total max network amps
 TWCsTotalMaxAmps = 16.0     # max total current for all wall connectors
 TWCMaxAmps = 16.0           # max current per wall connector
 
 #Globals
-initialized = False         # has the master been initialized
-masterTWCId = 0x8888        # TWC id of this master
-masterTWCSign = 0x88        # Sign of this master
-twcList = []                # TWC slaves
-dataIn = bytearray([])      # data received from serial interface
-sendDataCallback = None     # callback function for sending data to serial interface
-otherAmpsHistList = []      # history list with amps in use by other devices
+MASTERTWCID = 0x8888        # TWC id of the master
+MASTERTWCSIGN = 0x88        # Sign of the master
 otherAmpsHistMaxCount = 60  # max size of history list ~ 1 minute
-
-# Input vars
-scheduledMaxAmps = 99.0     # total max current for all TWCs set by schedule
-actualTotalPower = [0.0]    # actual total power per phase in use by all devices including TWCs
-actualTolalPowerChanged = time.time()
-actualVolts = [230]         # actual volts per phase, used for calculating amps - power
-
-# Output vars
-totalAmps = 0.0             # total current in use by all devices on one phase
-totalChargingAmps = 0.0     # total current for all TWCs used for charging
-twcTotalAvailableAmps = 0.0 # current available for all TWCs
+otherAmpsHistMaxAge = 0     # max age in seconds of history values, 0: use otherAmpsHistMaxCount
 
 # logging
 LogLevel = logging.DEBUG
@@ -50,6 +70,295 @@ LogFile = "twcmaster.log"
 
 
 
+# state file: header, TWCs, other amps history per phase, little endian
+STATEMAGIC = b"TWCS"
+STATEVERSION = 2
+STATEHEADER = struct.Struct("<4sBdHBB")     # magic, version, time, master twcId, number of twcs, number of phases
+STATETWC = struct.Struct("<HBBBffffIdd3H")  # twcId, version, state, phases bitmask, maxAmps, setAmps, availableAmps, actualAmps, totalKwh, calculatedWatts, energyWh, volts
+STATEHIST = struct.Struct("<IH")            # values pushed, number of values in window
+STATEHISTVALUE = struct.Struct("<Idd")      # index, time, value
+
+
+# Frame decoder for data received from serial interface
+# received data is copied once into a preallocated buffer and frames are parsed in place,
+# frames are separated by 0xc0 bytes. Frames without escapes are returned as a memoryview on the buffer,
+# valid until the next feed: copy a frame that is kept (bytes(frame))
+class FrameDecoder:
+    BUFFERSIZE = 4096       # initial buffer size, the buffer grows when a feed does not fit
+
+    def __init__(self, size = BUFFERSIZE):
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.offset = 0     # start of the data not decoded yet
+        self.end = 0        # end of the received data
+
+    # add data (bytes, bytearray or memoryview) received from serial interface
+    def feed(self, data):
+        n = len(data)
+        if self.end + n > len(self.buffer):
+            self.makeRoom(n)
+        self.view[self.end:self.end + n] = data
+        self.end += n
+
+    # move the data not decoded yet to the start of the buffer, use a new larger buffer when n bytes do not fit
+    # frames returned before stay valid in a replaced buffer
+    def makeRoom(self, n):
+        pending = self.end - self.offset
+        if pending + n > len(self.buffer):
+            buffer = bytearray(max(2 * len(self.buffer), pending + n))
+            buffer[:pending] = self.view[self.offset:self.end]
+            self.buffer = buffer
+            self.view = memoryview(buffer)
+        else:
+            self.view[:pending] = self.buffer[self.offset:self.end]
+        self.offset = 0
+        self.end = pending
+
+    # number of bytes waiting to be decoded
+    def pending(self):
+        return self.end - self.offset
+
+    # get the next unescaped frame between two 0xc0 bytes, None when no complete frame available
+    def nextFrame(self):
+        buf = self.buffer
+        end = self.end
+        while True:
+            start = buf.find(b"\xc0", self.offset, end)
+            if start < 0:
+                # no frame start, discard data
+                self.offset = self.end = 0
+                return None
+            frameEnd = buf.find(b"\xc0", start + 1, end)
+            if frameEnd < 0:
+                # incomplete frame, keep data from frame start
+                self.offset = start
+                return None
+            # the end byte is the start of the next frame
+            self.offset = frameEnd
+            if frameEnd - start > 1:
+                if buf.find(b"\xdb", start + 1, frameEnd) < 0:
+                    return self.view[start + 1:frameEnd]
+                return unescapeData(self.view[start + 1:frameEnd])
+
+    # yield all complete frames
+    def frames(self):
+        frame = self.nextFrame()
+        while frame != None:
+            yield frame
+            frame = self.nextFrame()
+
+
+# Sliding window maximum
+# keeps only values that can still become the maximum in a monotonic deque (value decreasing),
+# push and max are amortized O(1). The window is limited by count, and by age when maxAge > 0
+class SlidingMax:
+    def __init__(self, maxCount, maxAge = 0):
+        self.maxCount = maxCount
+        self.maxAge = maxAge
+        self.window = collections.deque()   # (index, time, value)
+        self.count = 0                      # number of values pushed
+
+    # add value
+    def push(self, value, now = None):
+        if now == None:
+            now = time.time()
+        window = self.window
+        # values lower or equal than the new value can never be the maximum again
+        while window and window[-1][2] <= value:
+            window.pop()
+        window.append((self.count, now, value))
+        self.count += 1
+        self.expire(now)
+
+    # remove values outside the window
+    def expire(self, now):
+        window = self.window
+        if self.maxAge > 0:
+            while window and window[0][1] < now - self.maxAge:
+                window.popleft()
+        else:
+            while window and window[0][0] <= self.count - 1 - self.maxCount:
+                window.popleft()
+
+    # highest value in window, default when window is empty
+    def max(self, default = 0.0):
+        if self.window:
+            return self.window[0][2]
+        return default
+
+    # remove all values
+    def clear(self):
+        self.window.clear()
+
+
+# Load forecast for the amps in use by other devices, used instead of the max of the history
+# exponentially weighted mean and variance with time constant tau, O(1) per value
+# forecast = max(highest value in the last horizon seconds, mean + sigmas * standard deviation) + margin
+# a spike is only used for the ramp horizon (INCAMPSDELAY), the variance keeps some room for the next one
+class LoadForecast:
+    def __init__(self, tau = FORECASTTAU, sigmas = FORECASTSIGMAS, margin = FORECASTMARGIN, horizon = None):
+        self.tau = tau
+        self.sigmas = sigmas
+        self.margin = margin
+        self.recent = SlidingMax(0, INCAMPSDELAY if horizon == None else horizon)
+        self.mean = None
+        self.variance = 0.0
+        self.lastTime = None
+
+    # add value
+    def push(self, value, now):
+        if self.mean == None:
+            self.mean = value
+        else:
+            alpha = 1.0 - math.exp(-max(now - self.lastTime, 0.0) / self.tau)
+            diff = value - self.mean
+            incr = alpha * diff
+            self.mean += incr
+            self.variance = (1.0 - alpha) * (self.variance + diff * incr)
+        self.lastTime = now
+        self.recent.push(value, now)
+
+    # new forecast with the same parameters, without values
+    def copy(self):
+        return LoadForecast(self.tau, self.sigmas, self.margin, self.recent.maxAge)
+
+    # forecast of the highest value in the next horizon seconds, default when no values
+    def forecast(self, default = 0.0):
+        if self.mean == None:
+            return default
+        return max(self.recent.max(), self.mean + self.sigmas * math.sqrt(self.variance)) + self.margin
+
+    # remove all values
+    def clear(self):
+        self.mean = None
+        self.variance = 0.0
+        self.recent.clear()
+
+
+# Solar controller: current for the twc's from the power exported to the grid, used in solar mode
+# the power per phase is signed, negative is export. PI controller on the surplus in amps per phase,
+# on top of the actual charging current:
+#     surplus = (target - sum of power) / (volts * phases with twc's)
+#     amps = charging amps + kp * surplus + integral,  integral += ki * surplus * dt
+# surplus within +/- band is not corrected, the integral is limited to +/- SOLARINTEGRALMAX and not raised
+# when the amps are at the max or lowered when at TWCMINAMPS (anti-windup).
+# charging starts when amps >= TWCMINAMPS + SOLARSTARTMARGIN and stops when amps < TWCMINAMPS, both for
+# SOLARDELAY seconds, in between TWCMINAMPS is used. minAmps > 0: always charge with at least minAmps
+class SolarController:
+    def __init__(self, target = SOLARTARGET, minAmps = 0.0, kp = SOLARKP, ki = SOLARKI, band = SOLARBAND):
+        self.target = target
+        self.minAmps = minAmps
+        self.kp = kp
+        self.ki = ki
+        self.band = band
+        self.integral = 0.0
+        self.amps = 0.0                 # last output
+        self.running = None             # charging started, None: not known before the first update
+        self.changed = None             # time the amps crossed the start or stop level
+        self.lastTime = None            # time of the last power reading used
+
+    # amps per phase for the twc's, power: signed power per phase read at powerTime, volt: lowest volts,
+    # phases: number of phases with twc's, chargingAmps: actual amps per phase of the twc's
+    def update(self, power, powerTime, volt, phases, chargingAmps, maxAmps):
+        # only new power readings change the output
+        if powerTime == self.lastTime:
+            return self.amps
+        dt = 0.0 if self.lastTime == None else min(powerTime - self.lastTime, TIMETOSAVEMODE)
+        self.lastTime = powerTime
+        if self.running == None:
+            self.running = chargingAmps > 0.5
+
+        surplus = (self.target - sum(power)) / (volt * max(phases, 1))
+        if abs(surplus) < self.band:
+            surplus = 0.0
+        if chargingAmps > 0.5:
+            amps = chargingAmps + self.kp * surplus + self.integral
+            # anti-windup: no integration when the output can't follow
+            if not (((amps >= maxAmps) and (surplus > 0)) or ((amps <= TWCMINAMPS) and (surplus < 0))):
+                self.integral = max(min(self.integral + self.ki * surplus * dt, SOLARINTEGRALMAX), -SOLARINTEGRALMAX)
+                amps = chargingAmps + self.kp * surplus + self.integral
+        else:
+            # not charging: the surplus is available
+            self.integral = 0.0
+            amps = surplus
+
+        # start and stop hysteresis
+        if self.running:
+            if amps < TWCMINAMPS:
+                if self.changed == None:
+                    self.changed = powerTime
+                if powerTime - self.changed >= SOLARDELAY:
+                    self.running = False
+                    self.changed = None
+                    logging.info("Solar STOP charging, surplus %.2f", amps)
+                else:
+                    amps = TWCMINAMPS
+            else:
+                self.changed = None
+        else:
+            if amps >= TWCMINAMPS + SOLARSTARTMARGIN:
+                if self.changed == None:
+                    self.changed = powerTime
+                if powerTime - self.changed >= SOLARDELAY:
+                    self.running = True
+                    self.changed = None
+                    logging.info("Solar START charging, surplus %.2f", amps)
+            else:
+                self.changed = None
+        if not self.running:
+            amps = 0.0
+
+        self.amps = max(min(max(amps, self.minAmps), maxAmps), 0.0)
+        return self.amps
+
+
+# Frame trace: the last frames send and received in a ring buffer, formatted only when dumped
+# at most rate frames per second are added (token bucket), the others are counted as skipped
+class FrameTrace:
+    def __init__(self, size = TRACESIZE, rate = TRACERATE):
+        self.frames = collections.deque(maxlen=size)   # (time, direction, frame)
+        self.rate = rate
+        self.tokens = rate
+        self.lastTime = 0.0
+        self.skipped = 0                    # frames not added because of the rate limit
+        self.lastDump = None                # time of the last dump on error
+
+    # add frame, direction is "send" or "recv", the frame (bytes, bytearray or memoryview) is copied when it is added
+    def add(self, now, direction, frame):
+        if self.rate > 0:
+            self.tokens = min(self.rate, self.tokens + (now - self.lastTime) * self.rate)
+            self.lastTime = now
+            if self.tokens < 1.0:
+                self.skipped += 1
+                return
+            self.tokens -= 1.0
+        self.frames.append((now, direction, bytes(frame)))
+
+    # formatted trace lines, oldest first
+    def lines(self):
+        return ["%.3f %s %s" % (t, direction, binascii.hexlify(frame).decode()) for t, direction, frame in self.frames]
+
+    # write the trace to the debug log
+    def dump(self, reason):
+        logging.debug("Frame trace (%s), %d frames, %d skipped:", reason, len(self.frames), self.skipped)
+        for line in self.lines():
+            logging.debug("  %s", line)
+
+    # write the trace to the debug log on an error, at most once per TRACEDUMPINTERVAL seconds
+    # only when debugging, the error itself is logged as a single warning
+    def dumpOnError(self, reason, now):
+        if not logging.getLogger().isEnabledFor(logging.DEBUG):
+            return
+        if (self.lastDump == None) or (now - self.lastDump >= TRACEDUMPINTERVAL):
+            self.lastDump = now
+            self.dump(reason)
+
+    # remove all frames
+    def clear(self):
+        self.frames.clear()
+        self.skipped = 0
+
+
 # TWC slave object
 class TWC:
     # TWC slave states
@@ -63,9 +372,19 @@ class TWC:
     DECCHARGE = 7
     STARTCHARGING = 8
     CHANGECHARGE = 9
+    INACTIVESTATES = frozenset([NONE, DONOTCHARGE, READYTOCHARGE])
+
+    # no per instance __dict__, keeps slave objects small
+    __slots__ = ("master", "twcId", "twcVersion", "state", "maxAmps", "startAmps", "availableAmps", "actualAmps",
+                 "lastDataChanged", "totalKwh", "volts", "lastKwhVoltsRequested", "actualPower", "calculatedWatts", "energyWh",
+                 "desiredAmps", "setAmps", "lastAmpsChanged", "startChargingTime", "phases",
+                 "rampSecondsPerAmp", "rampSamples", "rampStart", "rampTo", "rampStep",
+                 "noChangeFrame", "kwhVoltsFrame", "ampsMsg", "ampsChecksum", "ampsFrame", "ampsFrameAmps")
 
     # on init set data received from slave linkready msg
-    def __init__(self, twcId, maxAmps, version):
+    def __init__(self, master, twcId, maxAmps, version, now, phases = ALLPHASES):
+        self.master = master
+        self.phases = phases            # phases (0..2) the TWC is wired to
         # data received from TWC
         self.twcId = twcId
         self.twcVersion = version
@@ -76,55 +395,116 @@ class TWC:
             self.startAmps = 21.0
         self.availableAmps = 0.0
         self.actualAmps = 0.0
-        self.lastDataChanged = time.time()
+        self.lastDataChanged = now
         self.totalKwh = 0
-        self.volts = []
+        self.volts = array("H", [0, 0, 0])
         self.lastKwhVoltsRequested = 0
         self.actualPower = 0.0
-        self.calculatedWatts = 0.0
+        self.calculatedWatts = 0.0      # Wh since totalKwh changed
+        self.energyWh = 0.0             # Wh since the TWC linked, never cleared
         # TWC settings
         self.desiredAmps = 0
         self.setAmps = 0
         self.lastAmpsChanged = 0
         self.startChargingTime = 0
+        # ramp: response time of the car learned from increases of setAmps
+        self.resetRamp()
+        # heartbeat frames, framed and escaped
+        self.createFrames()
 
     # set data received from slave heartbeat msg
-    def setDataFromTWC(self, state, availAmps, actualAmps):
+    def setDataFromTWC(self, state, availAmps, actualAmps, now):
         if (self.state != state):
             logging.info("TWC(%04x) state changed from %d to %d", self.twcId, self.state, state)
+            # car unplugged, the next car responds in its own time
+            if (state == TWC.NONE):
+                self.resetRamp()
         self.state = state
         self.availableAmps = availAmps
         self.actualAmps = actualAmps
-        # calc actual power, use actual volts for calculating powwer, twc volts can be lower
+        if (self.rampStart != None):
+            self.observeRamp(now)
+        # calc actual power, use actual volts of the phases of the twc for calculating powwer, twc volts can be lower
         p = 0.0
-        for v in actualVolts:
-            p += v * self.actualAmps
+        volts = self.master.actualVolts
+        for i in self.phases:
+            if i < len(volts):
+                p += volts[i] * actualAmps
+        # calc watts/h: trapezoid, mean of the previous and the actual power
+        wh = (now - self.lastDataChanged) * (self.actualPower + p) / 7200.0
+        self.calculatedWatts += wh
+        self.energyWh += wh
         self.actualPower = p
-        # calc watts/h
-        now = time.time()
-        self.calculatedWatts += (now - self.lastDataChanged) * p / 3600.0
         self.lastDataChanged = now
 
     # set kwh/volts data received from twc
     def setKwhVoltsFromTWC(self, kwh, volts):
-        # clear calculatedWatts when kwh changed
+        # when kwh changed keep the part of calculatedWatts not in kwh yet, kwh + calculatedWatts never decreases
+        # the kwh counter is 32 bits, a decrease is a rollover
         if (kwh != self.totalKwh):
-            self.calculatedWatts = 0.0
+            step = (kwh - self.totalKwh) & 0xFFFFFFFF
+            if (self.totalKwh > 0) and (step <= KWHMAXSTEP):
+                self.calculatedWatts = max(self.calculatedWatts - step * 1000.0, 0.0)
+            else:
+                # first reading or counter reset
+                self.calculatedWatts = 0.0
         self.totalKwh = kwh
-        self.volts = volts
+        for i in range(min(len(volts), 3)):
+            self.volts[i] = volts[i]
+
+    # forget the learned response time
+    def resetRamp(self):
+        self.rampSecondsPerAmp = 0.0    # learned seconds per amp the car takes to follow an increase
+        self.rampSamples = 0            # number of increases the car followed
+        self.rampStart = None           # time of the increase being observed, None: no increase observed
+        self.rampTo = 0.0               # set amps of the observed increase
+        self.rampStep = 0.0             # amps the car has to increase
+
+    # an increase is observed: learn the response time when the car reached the set amps
+    def observeRamp(self, now):
+        if (self.actualAmps >= self.rampTo - RAMPTOLERANCE):
+            sample = (now - self.rampStart) / self.rampStep
+            if (self.rampSamples == 0):
+                self.rampSecondsPerAmp = sample
+            else:
+                self.rampSecondsPerAmp += RAMPALPHA * (sample - self.rampSecondsPerAmp)
+            self.rampSamples += 1
+            self.rampStart = None
+        elif (self.setAmps < self.rampTo) or (now - self.rampStart > RAMPTIMEOUT):
+            # decreased, or the car limits itself: no response time
+            self.rampStart = None
+
+    # the car is charging and followed an increase before
+    def isRampKnown(self):
+        return (self.rampSamples > 0) and (self.actualAmps > 0.5)
+
+    # delay after the last change before the current can be increased
+    # not charging or unknown car: INCAMPSDELAY, car reached the last setting: RAMPMINDELAY,
+    # otherwise the time the car is expected to take for the last increase
+    def getIncAmpsDelay(self):
+        if (not self.isRampKnown()):
+            delay = INCAMPSDELAY
+        elif (self.rampStart == None):
+            delay = RAMPMINDELAY
+        else:
+            delay = max(self.rampSecondsPerAmp * self.rampStep + RAMPMARGIN, RAMPMINDELAY)
+        # solar mode follows the surplus faster
+        if self.master.solar:
+            delay = min(delay, SOLARINCAMPSDELAY)
+        return min(delay, INCAMPSDELAY)
 
     # is this TWC charging or ready to charge
     def isActive(self):
-        return (self.state not in {TWC.NONE, TWC.DONOTCHARGE, TWC.READYTOCHARGE}) or (self.actualAmps > 0.5)
+        return (self.state not in TWC.INACTIVESTATES) or (self.actualAmps > 0.5)
 
     # dead when the slave is not sending heartbeats and charging not stopped
-    def isDead(self):
-        return (self.lastDataChanged < time.time() - TIMETODELTWC) and (self.setAmps > 0)
+    def isDead(self, now):
+        return (self.lastDataChanged < now - TIMETODELTWC) and (self.setAmps > 0)
 
-    # get heartbeat msg to send
-    def getHeartBeatMsg(self):
+    # get heartbeat frame to send, None when no heartbeat must be send
+    def getHeartBeatFrame(self, now):
         # never use more current TWC or wiring can handle
-        self.desiredAmps = math.trunc(min(self.desiredAmps, self.maxAmps, TWCMaxAmps))
+        self.desiredAmps = math.trunc(min(self.desiredAmps, self.maxAmps, self.master.twcMaxAmps))
 
         # check if charging was stopped
         if (self.setAmps == 0):
@@ -134,7 +514,7 @@ class TWC:
                 self.desiredAmps = 0
 
         # set amps for TWC when desired is lower
-        if ((self.desiredAmps < self.availableAmps) and (self.lastAmpsChanged < time.time() - DECAMPSDELAY)):
+        if ((self.desiredAmps < self.availableAmps) and (self.lastAmpsChanged < now - DECAMPSDELAY)):
             # stop charging when disered < min
             if (self.desiredAmps < TWCMINAMPS):
                 self.setAmps = 0
@@ -142,25 +522,31 @@ class TWC:
                 self.setAmps = self.desiredAmps
 
         # set amps when desired is higher and TWC is charging
-        if ((self.desiredAmps > self.availableAmps) and (self.lastAmpsChanged < time.time() - INCAMPSDELAY)
+        if ((self.desiredAmps > self.availableAmps) and (self.lastAmpsChanged < now - self.getIncAmpsDelay())
             and (self.state not in [TWC.CHANGECHARGE])):
             if (self.isActive()):
                 # charging: increase with 50%, will prevent fluctuation in charge settings
+                # a charging car that followed an increase before gets the desired amps in one step
                 diff = self.desiredAmps - self.actualAmps
-                if (diff >= 3):
+                if (diff >= 3) and (not self.isRampKnown()):
                     self.desiredAmps = max(math.trunc(self.actualAmps + ((diff+1)/2)), self.availableAmps)
                 self.setAmps = self.desiredAmps
+                # observe how fast the car follows
+                if (self.setAmps > self.actualAmps + RAMPTOLERANCE):
+                    self.rampStart = now
+                    self.rampTo = self.setAmps
+                    self.rampStep = self.setAmps - self.actualAmps
             else:
                 # not active set to start amps
                 self.setAmps = min(self.desiredAmps, self.startAmps)
 
         # delay 5 seconds after charging has started
-        if ((self.availableAmps > 0) and (time.time() < self.startChargingTime + STARTCHARGETIME)):
+        if ((self.availableAmps > 0) and (now < self.startChargingTime + STARTCHARGETIME)):
             self.setAmps = self.startAmps
         # start charging?
         elif ((self.state != TWC.NONE) and (self.desiredAmps >= TWCMINAMPS) and (self.availableAmps == 0)):
             self.setAmps = self.startAmps
-            self.startChargingTime = time.time()
+            self.startChargingTime = now
             logging.info("TWC(%04x) START charging %.2f", self.twcId, self.setAmps)
 
         # stop charging?
@@ -168,30 +554,52 @@ class TWC:
             logging.info("TWC(%04x) STOP charging", self.twcId)
 
         if (self.twcVersion == 1):
-            return self.createHeartBeatMsg1()
+            return self.createHeartBeatFrame1(now)
         else:
-            return self.createHeartBeatMsg2()
-
-    # Heartbeat message for version 1 twc
-    def createHeartBeatMsg1(self):
-        # heartbeat msg = FBE0 mastedid slaveid 05 amps*100
-        msg = bytearray([0xfb, 0xe0, (masterTWCId>>8) & 0xFF, masterTWCId & 0xFF, (self.twcId>>8) & 0xFF, self.twcId & 0xFF])
-
+            return self.createHeartBeatFrame2(now)
+
+    # create the frames that do not change: no change heartbeat, kwh/volts request and the set amps template
+    def createFrames(self):
+        masterTWCId = self.master.masterTWCId
+        header = bytearray([0xfb, 0xe0, (masterTWCId>>8) & 0xFF, masterTWCId & 0xFF, (self.twcId>>8) & 0xFF, self.twcId & 0xFF])
+        # version 1: 7 data bytes, version 2: 9 data bytes
+        datalen = 7 if (self.twcVersion == 1) else 9
+        # heartbeat msg = FBE0 mastedid slaveid 00..
+        self.noChangeFrame = encodeFrame(header + bytes(datalen))
+        # set amps msg = FBE0 mastedid slaveid 05/09 amps*100 00.., twc version 2 uses 0x09 for changing current
+        self.ampsMsg = header + bytearray([0x05 if (self.twcVersion == 1) else 0x09]) + bytes(datalen - 1)
+        self.ampsChecksum = calcChecksum(self.ampsMsg, 1, len(self.ampsMsg))
+        self.ampsFrame = None
+        self.ampsFrameAmps = None
+        # kwh/volts msg = FBEB mastedid slaveid 00..
+        self.kwhVoltsFrame = encodeFrame(bytearray([0xfb, 0xeb]) + header[2:] + bytes(9))
+
+    # get the set amps frame, only the amps and the checksum are changed when setAmps changed
+    def getAmpsFrame(self):
+        if (self.ampsFrameAmps != self.setAmps):
+            hundredthsOfAmps = int(self.setAmps * 100)
+            msg = self.ampsMsg
+            msg[7] = (hundredthsOfAmps >> 8) & 0xFF
+            msg[8] = hundredthsOfAmps & 0xFF
+            checksum = (self.ampsChecksum + msg[7] + msg[8]) & 0xFF
+            self.ampsFrame = b"\xc0" + escapeData(msg + bytes([checksum])) + b"\xc0\xfe"
+            self.ampsFrameAmps = self.setAmps
+        return self.ampsFrame
+
+    # Heartbeat frame for version 1 twc
+    def createHeartBeatFrame1(self, now):
         # set new max amps or stop charging when setAmps = 0
         if ((self.state != TWC.NONE) and (self.availableAmps != self.setAmps) or (self.setAmps == 0)):
-            hundredthsOfAmps = int(self.setAmps * 100)
-            msg.extend(bytearray([0x05, (hundredthsOfAmps >> 8) & 0xFF, hundredthsOfAmps & 0xFF, 0x00,0x00,0x00,0x00]))
             if (self.availableAmps != self.setAmps):
-                self.lastAmpsChanged = time.time()
+                self.lastAmpsChanged = now
                 logging.info("TWC(%04x) set max amps to: %.2f", self.twcId, self.setAmps)
-        else:
-            # no change needed
-            msg.extend(bytearray([0x00,0x00,0x00,0x00,0x00,0x00,0x00]))
+            return self.getAmpsFrame()
 
-        return msg
+        # no change needed
+        return self.noChangeFrame
 
-    # Heartbeat message for version 2 twc
-    def createHeartBeatMsg2(self):
+    # Heartbeat frame for version 2 twc
+    def createHeartBeatFrame2(self, now):
         # twc version 2 can't stop charging, set charge to minimum, and stop communication
         if ((self.state != TWC.NONE) and (self.setAmps == 0)):
             if (self.availableAmps > TWCMINAMPS):
@@ -204,34 +612,1057 @@ class TWC:
                 self.actualPower = 0.0
                 return None
 
-        # heartbeat msg = FBE0 mastedid slaveid 09/05 amps*100
-        msg = bytearray([0xfb, 0xe0, (masterTWCId>>8) & 0xFF, masterTWCId & 0xFF, (self.twcId>>8) & 0xFF, self.twcId & 0xFF])
         # set charge setting when changed or charging and setting != actual
         if ((self.state != TWC.NONE) and (self.availableAmps != self.setAmps)):
-            # twc version 2 uses 0x09 for changing current
-            cmd = 0x09
-            # set new max charge amps
-            hundredthsOfAmps = int(self.setAmps * 100)
-            msg.extend(bytearray([cmd, (hundredthsOfAmps >> 8) & 0xFF, hundredthsOfAmps & 0xFF, 0x00,0x00,0x00,0x00,0x00,0x00]))
-            self.lastAmpsChanged = time.time()
+            self.lastAmpsChanged = now
             logging.info("TWC(%04x) set max amps to: %.2f", self.twcId, self.setAmps)
-        else:
-            # no change needed: request kwh/volts or send no change heartbeat
-            kwhmsg = self.getKwhVoltsMsg()
-            if (kwhmsg):
-                return kwhmsg
-            msg.extend(bytearray([0x00,0x00,0x00,0x00,0x00,0x00,0x000,0x00,0x00]))
+            return self.getAmpsFrame()
 
-        return msg
+        # no change needed: request kwh/volts or send no change heartbeat
+        kwhframe = self.getKwhVoltsFrame(now)
+        if (kwhframe):
+            return kwhframe
+        return self.noChangeFrame
 
-    # get the kwh/volts from twc every minute
-    def getKwhVoltsMsg(self):
+    # get the kwh/volts request frame from twc every minute
+    def getKwhVoltsFrame(self, now):
         # only for TWC verion 2 and once per minute
-        if ((self.twcVersion == 2) and (self.lastKwhVoltsRequested < time.time() - 60)):
-            self.lastKwhVoltsRequested = time.time()
-            return bytearray([0xfb, 0xeb, (masterTWCId>>8) & 0xFF, masterTWCId & 0xFF, (self.twcId>>8) & 0xFF, self.twcId & 0xFF, 0x00,0x00,0x00,0x00,0x00,0x00,0x00,0x00,0x00])
+        if ((self.twcVersion == 2) and (self.lastKwhVoltsRequested < now - 60)):
+            self.lastKwhVoltsRequested = now
+            return self.kwhVoltsFrame
+        return None
+
+
+# get checksum for message
+def calcChecksum(msg, start, end):
+    return sum(msg[start:end]) & 0xFF
+
+
+# escape msg data
+def escapeData(msg):
+    #escape db with dbdd first, then c0 with dbdc
+    return bytearray(bytes(msg).replace(b"\xdb", b"\xdb\xdd").replace(b"\xc0", b"\xdb\xdc"))
+
+
+# escape byte sequence: 0xdb followed by the escaped byte, a 0xdb at the end is dropped
+ESCAPEPATTERN = re.compile(b"\xdb(.)?", re.DOTALL)
+UNESCAPETABLE = {b"\xdc": b"\xc0", b"\xdd": b"\xdb"}
+
+
+# unescape one escape sequence
+def unescapeMatch(match):
+    b = match.group(1)
+    if b == None:
+        return b""
+    data = UNESCAPETABLE.get(b)
+    if data == None:
+        logging.error("Unknown escape byte sequence 0xdb %02x", b[0])
+        return b
+    return data
+
+
+# unescape msg data
+def unescapeData(msg):
+    data = bytes(msg)
+    escapes = data.count(b"\xdb")
+    if escapes == 0:
+        return bytearray(data)
+    # valid escape sequences only: replace dbdc first, the byte after an escape is never db
+    if escapes == data.count(b"\xdb\xdc") + data.count(b"\xdb\xdd"):
+        return bytearray(data.replace(b"\xdb\xdc", b"\xc0").replace(b"\xdb\xdd", b"\xdb"))
+    return bytearray(ESCAPEPATTERN.sub(unescapeMatch, data))
+
+
+# create frame for msg: add checksum, escape and add pre and postfix
+def encodeFrame(msg):
+    data = bytearray(msg)
+    data.append(calcChecksum(data, 1, len(data)))
+    return b"\xc0" + escapeData(data) + b"\xc0\xfe"
+
+
+# Virtual clock, set the time for running the master faster than real time
+# callLater can be used as send timer callback, the timers run when the time is moved forward with runUntil
+class VirtualClock:
+    def __init__(self, now = 0.0):
+        self.now = now
+        self.timers = []                    # heap of (time, sequence, func)
+        self.sequence = 0
+
+    # get the time in seconds
+    def __call__(self):
+        return self.now
+
+    # set the time, the clock never goes back
+    def set(self, now):
+        self.now = max(self.now, now)
+
+    # move the time forward
+    def advance(self, seconds):
+        self.runUntil(self.now + seconds)
+
+    # call func after delay seconds
+    def callLater(self, delay, func):
+        self.sequence += 1
+        heapq.heappush(self.timers, (self.now + max(delay, 0.0), self.sequence, func))
+
+    # time of the next timer, None when no timer
+    def nextTimer(self):
+        if self.timers:
+            return self.timers[0][0]
         return None
 
+    # run the timers until time and set the time
+    def runUntil(self, now):
+        while self.timers and (self.timers[0][0] <= now):
+            due, _, func = heapq.heappop(self.timers)
+            self.set(due)
+            func()
+        self.set(now)
+
+
+# Even allocator: every active TWC gets an equal share of the available current on each of its phases
+# the lowest share is used, inactive TWCs get the same share for starting
+class EvenAllocator:
+    # set desiredAmps of the twc's of master, available: amps per phase for all twc's
+    def allocate(self, master, available, now):
+        phases = len(available)
+        phaseTWCs = [0] * phases
+        for twc in master.twcs.values():
+            if twc.isActive():
+                for i in twc.phases:
+                    if i < phases:
+                        phaseTWCs[i] += 1
+        for twc in master.twcs.values():
+            availablePerTWC = master.twcMaxAmps
+            for i in twc.phases:
+                if i < phases:
+                    availablePerTWC = min(availablePerTWC, available[i] / max(phaseTWCs[i], 1))
+            twc.desiredAmps = math.trunc(max(availablePerTWC, 0))
+
+
+# Water filling allocator: the available current is raised for all twc's with a car at the same time, weighted by
+# priority, until the twc reaches its cap or one of its phases is full. Current a twc can't use goes to the others
+#     cap: max amps of the twc, when the car uses less than set (tapering): actual amps + TAPERMARGIN
+#     minimum: guaranteed amps, given first in order of weight, the weighted share comes on top
+#     a twc below TWCMINAMPS can't charge: the lowest priority one is stopped and the current is shared again,
+#     a stopped twc is only started with TWCMINAMPS + STARTMARGIN and not within RESTARTDELAY seconds after it
+#     was stopped for lack of current, this prevents starting and stopping
+class WaterFillAllocator:
+    def __init__(self, weights = None, minimums = None):
+        self.weights = dict(weights) if weights else {}     # weight per twcId, default 1
+        self.minimums = dict(minimums) if minimums else {}  # guaranteed amps per twcId, default 0
+        self.stopped = {}                                   # time a twc was stopped for lack of current, per twcId
+        for twcId, weight in self.weights.items():
+            self.checkWeight(twcId, weight)
+
+    # a weight is the fill rate of a twc, it must be positive
+    @staticmethod
+    def checkWeight(twcId, weight):
+        if not weight > 0:
+            raise ValueError("TWC(%04x) weight must be positive: %s" % (twcId, weight))
+
+    # set weight (> 0) and guaranteed amps of a twc
+    def setPriority(self, twcId, weight = 1.0, minimum = 0.0):
+        self.checkWeight(twcId, weight)
+        self.weights[twcId] = weight
+        self.minimums[twcId] = minimum
+
+    # max current the twc can use
+    def getCap(self, master, twc, now):
+        cap = min(master.twcMaxAmps, twc.maxAmps)
+        # car uses less than set for longer than the ramp delay: tapering or limited by the car
+        # not below the min current, a car that draws less must not stop the twc
+        if ((twc.state == TWC.CHARGING) and (twc.lastAmpsChanged < now - INCAMPSDELAY)
+            and (twc.actualAmps + TAPERMARGIN / 2 < twc.setAmps)):
+            cap = min(cap, max(twc.actualAmps + TAPERMARGIN, TWCMINAMPS))
+        return cap
+
+    # fill available per phase: returns amps per twc
+    def fill(self, twcs, caps, available):
+        remaining = list(available)
+        phases = len(remaining)
+        alloc = {}
+        twcPhases = {}
+        for twc in twcs:
+            twcPhases[twc] = [i for i in twc.phases if i < phases]
+        # guaranteed minimums first, highest weight first
+        for twc in sorted(twcs, key=lambda twc: -self.weights.get(twc.twcId, 1.0)):
+            amps = min(self.minimums.get(twc.twcId, 0.0), caps[twc])
+            for i in twcPhases[twc]:
+                amps = min(amps, remaining[i])
+            amps = max(amps, 0.0)
+            alloc[twc] = amps
+            for i in twcPhases[twc]:
+                remaining[i] -= amps
+        # raise the level of all twc's that are not full
+        filling = [twc for twc in twcs if (alloc[twc] < caps[twc] - 1e-9) and all(remaining[i] > 1e-9 for i in twcPhases[twc])]
+        while filling:
+            rates = [0.0] * phases
+            step = None
+            for twc in filling:
+                weight = self.weights.get(twc.twcId, 1.0)
+                for i in twcPhases[twc]:
+                    rates[i] += weight
+                s = (caps[twc] - alloc[twc]) / weight
+                if (step == None) or (s < step):
+                    step = s
+            for i in range(phases):
+                if rates[i] > 0:
+                    step = min(step, remaining[i] / rates[i])
+            for twc in filling:
+                amps = self.weights.get(twc.twcId, 1.0) * step
+                alloc[twc] += amps
+                for i in twcPhases[twc]:
+                    remaining[i] -= amps
+            filling = [twc for twc in filling if (alloc[twc] < caps[twc] - 1e-9) and all(remaining[i] > 1e-9 for i in twcPhases[twc])]
+        return alloc
+
+    # set desiredAmps of the twc's of master, available: amps per phase for all twc's
+    def allocate(self, master, available, now):
+        # twc's with a car
+        candidates = [twc for twc in master.twcs.values() if ((twc.state != TWC.NONE) or (twc.actualAmps > 0.5))
+                      and ((twc.setAmps > 0) or (self.stopped.get(twc.twcId, now - RESTARTDELAY) <= now - RESTARTDELAY))]
+        caps = dict((twc, self.getCap(master, twc, now)) for twc in candidates)
+        while True:
+            alloc = self.fill(candidates, caps, available)
+            # twc's that can't charge, or can't start with the start margin, because the phases are full
+            # a twc that gets its cap is not short, unless the cap is below the min current
+            below = [twc for twc in candidates if (math.trunc(alloc[twc]) < (TWCMINAMPS if twc.setAmps > 0 else TWCMINAMPS + STARTMARGIN))
+                     and ((alloc[twc] < caps[twc] - 1e-9) or (caps[twc] < TWCMINAMPS))]
+            if not below:
+                break
+            # stop the lowest weight, not charging and highest id first
+            drop = min(below, key=lambda twc: (self.weights.get(twc.twcId, 1.0), twc.setAmps > 0, -twc.twcId))
+            candidates.remove(drop)
+            # only a twc stopped for lack of current waits for the restart delay
+            if (drop.setAmps > 0) and (alloc[drop] < caps[drop] - 1e-9):
+                self.stopped[drop.twcId] = now
+        for twc in master.twcs.values():
+            twc.desiredAmps = math.trunc(alloc.get(twc, 0.0))
+
+
+# TWC master for one RS485 bus
+# owns the slaves, the receive buffer, the send queue and the charge calculations for its bus
+# several masters can run in one process, masters on the same network connection share a SiteBudget
+# each master can run on its own thread: lock protects the slaves and the receive buffer
+class TWCMaster:
+    def __init__(self, twcId = MASTERTWCID, sign = MASTERTWCSIGN, clock = time.time):
+        self.lock = threading.RLock()               # held by update, heartbeat, received data and state load/save
+        self.clock = clock                          # function returning the time in seconds
+        self.recorder = None                        # wire recorder, records received and send data
+        self.stateFile = None                       # file for saving the state, None: not saved
+        self.nextStateSave = 0.0                    # time of the next state save
+        self.metrics = None                         # counters and histograms (twcmetrics.Metrics)
+        self.series = None                          # power and amps samples per TWC (twcseries.SeriesStore)
+        self.sessions = None                        # charging sessions per TWC (twcsessions.SessionTracker)
+        self.trace = FrameTrace()                   # last frames send and received
+        # config parameters
+        self.totalMaxAmps = TotalMaxAmps            # total max network amps
+        self.twcsTotalMaxAmps = TWCsTotalMaxAmps    # max total current for all wall connectors
+        self.twcMaxAmps = TWCMaxAmps                # max current per wall connector
+        self.site = None                            # site budget shared with other masters
+        # state
+        self.initialized = False                    # has the master been initialized
+        self.masterTWCId = twcId                    # TWC id of this master
+        self.masterTWCSign = sign                   # Sign of this master
+        self.twcs = {}                              # TWC slaves by twcId, in order of linkready
+        self.twcOrder = None                        # TWC slaves sorted by twcId, None when twcs changed
+        self.snapshot = array("d")                  # TWC data returned by getTWCsSnapshot
+        self.maxSlaves = MAXSLAVES                  # max number of slaves
+        self.frameDecoder = FrameDecoder()          # data received from serial interface
+        self.sendDataCallback = None                # callback function for sending data to serial interface
+        self.sendTimerCallback = None               # callback function(delay, func) for scheduling the next bus slot
+        self.sendQueue = collections.deque()        # framed messages waiting for a free bus slot
+        self.sendLock = threading.RLock()           # protects sendQueue, nextSendTime and sendTimer
+        self.nextSendTime = 0.0                     # time the bus is free for the next message
+        self.sendTimer = None                       # pending timer for releasing the next message
+        self.sendCount = 0                          # messages released to the serial interface
+        self.receivedSendCount = 0                  # sendCount when data was received last, data after a message can be its answer
+        self.twcPhases = {}                         # phases per twcId, TWCs not in the list use ALLPHASES
+        self.otherAmpsHist = [SlidingMax(otherAmpsHistMaxCount, otherAmpsHistMaxAge) for _ in range(MAXPHASES)]  # history per phase with amps in use by other devices
+        self.otherAmpsForecast = None               # forecast per phase of amps in use by other devices, None: use history
+        self.allocator = EvenAllocator()            # shares the available amps between the twc's
+        self.solar = None                           # solar mode: current from the power exported (SolarController), None: off
+        # input vars
+        self.scheduledMaxAmps = 99.0                # total max current for all TWCs set by schedule
+        self.actualTotalPower = [0.0]               # actual total power per phase in use by all devices including TWCs
+        self.actualTolalPowerChanged = self.clock()
+        self.actualVolts = [230]                    # actual volts per phase, used for calculating amps - power
+        # output vars
+        self.totalAmps = 0.0                        # total current in use by all devices on one phase
+        self.totalChargingAmps = 0.0                # total current for all TWCs used for charging
+        self.twcTotalAvailableAmps = 0.0            # current available for all TWCs
+        self.phaseAmps = [0.0]                      # current per phase in use by all devices
+        self.phaseChargingAmps = [0.0]              # current per phase in use by the TWCs
+        self.activeTWCs = 0                         # number of active TWCs at the last calculation
+        self.phaseAvailableAmps = [0.0]             # current per phase available for the TWCs
+
+    # set max currents
+    def setConfig(self, totalmax, twctotal, twc):
+        self.totalMaxAmps = totalmax
+        self.twcsTotalMaxAmps = min(twctotal, self.totalMaxAmps)
+        self.twcMaxAmps = min(twc, self.twcsTotalMaxAmps)
+        logging.info("Set max currents, Total all devices:%.2f Total TWC:%.2f Single TWC:%.2f", totalmax, twctotal, twc)
+
+    # Scheduled max current for all TWCs, set in scheduletwc event
+    def setScheduledMaxAmps(self, amps):
+        if self.recorder:
+            self.recorder.recordScheduledMaxAmps(amps)
+        amps = math.trunc(min(amps, self.twcsTotalMaxAmps))
+        if (amps != self.scheduledMaxAmps):
+            self.scheduledMaxAmps = amps
+            logging.info("ScheduledMaxAmps changed to: %.2f", amps)
+
+    # set the window for the amps in use by other devices history, the highest value in the window is used
+    # maxAge > 0: time based window of maxAge seconds, otherwise the last maxCount values
+    def setOtherAmpsHistory(self, maxCount, maxAge = 0):
+        for hist in self.otherAmpsHist:
+            hist.maxCount = maxCount
+            hist.maxAge = maxAge
+        logging.info("Other devices amps history: count:%d age:%.1f", maxCount, maxAge)
+
+    # set the forecast (LoadForecast) for the amps in use by other devices, used instead of the history max
+    # each phase gets its own copy. None: use the highest value in the history
+    def setOtherAmpsForecast(self, forecast = None):
+        self.otherAmpsForecast = [forecast] + [forecast.copy() for _ in range(1, MAXPHASES)] if forecast else None
+        logging.info("Other devices amps forecast: %s", "on" if forecast else "off")
+
+    # set the allocator that shares the available amps between the twc's, None: EvenAllocator
+    def setAllocator(self, allocator = None):
+        self.allocator = allocator if allocator else EvenAllocator()
+        logging.info("Allocator: %s", type(self.allocator).__name__)
+
+    # set solar mode: charge with the power exported to the grid (SolarController), None: off
+    # the power set with setActualPower must be signed, negative is export
+    def setSolarMode(self, solar = None):
+        self.solar = solar
+        logging.info("Solar mode: %s", "on" if solar else "off")
+
+    # set the phases (0..2) a TWC is wired to, e.g. (1,) for a single phase TWC on L2
+    # raises ValueError when the list is empty or has a phase out of range
+    def setTWCPhases(self, twcId, phases = ALLPHASES):
+        phases = tuple(sorted(set(phases)))
+        if (not phases) or (phases[0] < 0) or (phases[-1] >= MAXPHASES):
+            raise ValueError("TWC(%04x) phases must be 1 to %d: %s" % (twcId, MAXPHASES, ",".join(str(i + 1) for i in phases)))
+        self.twcPhases[twcId] = phases
+        twc = self.twcs.get(twcId)
+        if twc:
+            twc.phases = phases
+        logging.info("TWC(%04x) phases: %s", twcId, ",".join("L%d" % (i + 1) for i in phases))
+
+    # set actual volts from power supply, used for calculating twc power
+    def setActualVolts(self, volts):
+        if self.recorder:
+            self.recorder.recordVolts(volts)
+        self.actualVolts = volts
+
+    # Actual total power in use, set in powerchange event
+    def setActualPower(self, power):
+        if self.recorder:
+            self.recorder.recordPower(power)
+        now = self.clock()
+        self.actualTolalPowerChanged = now
+        self.actualTotalPower = power
+        # update charging settings
+        self.runUpdate(now)
+
+    # set the clock: function returning the time in seconds, e.g. time.time or a VirtualClock
+    def setClock(self, clock = time.time):
+        self.clock = clock
+
+    # set the method callback(bytearray) to call for sending data to TWC slaves over serial interface
+    def setSendDataCallback(self, callback = None):
+        self.sendDataCallback = callback
+
+    # set the method callback(delay, func) used to call func after delay seconds for releasing queued messages
+    # default a threading.Timer is used, set a callback when the caller has its own timer or event loop
+    def setSendTimerCallback(self, callback = None):
+        self.sendTimerCallback = callback
+
+    # set the wire recorder (twcrecord.WireRecorder) for recording all data in and out, None to stop recording
+    def setRecorder(self, recorder = None):
+        self.recorder = recorder
+
+    # set the file for saving the state every STATESAVEINTERVAL seconds, None: not saved
+    def setStateFile(self, path = None):
+        self.stateFile = path
+        self.nextStateSave = self.clock() + STATESAVEINTERVAL
+
+    # save slaves, other amps history and energy counters, written to a temporary file and renamed,
+    # a crash leaves the previous or the new file, never a partial one
+    def saveState(self, path = None):
+        path = path if path else self.stateFile
+        if not path:
+            return False
+        now = self.clock()
+        with self.lock:
+            phases = len(self.otherAmpsHist)
+            data = bytearray(STATEHEADER.pack(STATEMAGIC, STATEVERSION, now, self.masterTWCId, len(self.twcs), phases))
+            for twc in self.twcs.values():
+                mask = 0
+                for i in twc.phases:
+                    mask |= 1 << i
+                data += STATETWC.pack(twc.twcId, twc.twcVersion, twc.state, mask, twc.maxAmps, twc.setAmps, twc.availableAmps,
+                                      twc.actualAmps, twc.totalKwh, twc.calculatedWatts, twc.energyWh, *twc.volts)
+            for hist in self.otherAmpsHist:
+                data += STATEHIST.pack(hist.count, len(hist.window))
+                for index, t, value in hist.window:
+                    data += STATEHISTVALUE.pack(index, t, value)
+        tmp = path + ".tmp"
+        try:
+            with open(tmp, "wb") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, path)
+        except OSError as e:
+            logging.error("Save state to %s failed: %s", path, e)
+            return False
+        return True
+
+    # load the state saved by saveState, when not older than STATEMAXAGE the known slaves get heartbeats
+    # in the next update without sending linkready, returns True when the state is used
+    def loadState(self, path = None):
+        path = path if path else self.stateFile
+        if not path:
+            return False
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError as e:
+            logging.info("No state loaded from %s: %s", path, e)
+            return False
+        now = self.clock()
+        try:
+            magic, version, saved, masterTWCId, count, phases = STATEHEADER.unpack_from(data, 0)
+            if (magic != STATEMAGIC) or (version != STATEVERSION) or (masterTWCId != self.masterTWCId):
+                logging.warn("State file %s not compatible", path)
+                return False
+            if (saved < now - STATEMAXAGE) or (saved > now):
+                logging.info("State file %s too old: %.0f seconds", path, now - saved)
+                return False
+            offset = STATEHEADER.size
+            twcs = {}
+            for _ in range(count):
+                (twcId, twcVersion, state, mask, maxAmps, setAmps, availableAmps, actualAmps,
+                 totalKwh, calculatedWatts, energyWh, v1, v2, v3) = STATETWC.unpack_from(data, offset)
+                offset += STATETWC.size
+                # configured phases first, the config may have changed since the save
+                twcPhases = self.twcPhases.get(twcId, tuple(i for i in range(MAXPHASES) if mask & (1 << i)))
+                twc = TWC(self, twcId, maxAmps, twcVersion, now, twcPhases)
+                twc.state = state
+                twc.setAmps = setAmps
+                twc.availableAmps = availableAmps
+                twc.actualAmps = actualAmps
+                twc.totalKwh = totalKwh
+                twc.calculatedWatts = calculatedWatts
+                twc.energyWh = energyWh
+                twc.volts = array("H", [v1, v2, v3])
+                twc.lastAmpsChanged = now
+                twcs[twcId] = twc
+            hists = []
+            for _ in range(phases):
+                pushed, length = STATEHIST.unpack_from(data, offset)
+                offset += STATEHIST.size
+                window = []
+                for _ in range(length):
+                    window.append(STATEHISTVALUE.unpack_from(data, offset))
+                    offset += STATEHISTVALUE.size
+                hists.append((pushed, window))
+        except struct.error as e:
+            logging.warn("State file %s damaged: %s", path, e)
+            return False
+        with self.lock:
+            self.twcs = twcs
+            self.twcOrder = None
+            for hist, (pushed, window) in zip(self.otherAmpsHist, hists):
+                hist.count = pushed
+                hist.window = collections.deque(window)
+            self.initialized = True
+        logging.info("State loaded from %s, %d TWCs, %.0f seconds old", path, len(twcs), now - saved)
+        return True
+
+    # set the frame trace size and max frames per second, size 0 disables the trace
+    def setFrameTrace(self, size = TRACESIZE, rate = TRACERATE):
+        self.trace = FrameTrace(size, rate) if size > 0 else None
+
+    # write the frame trace to the debug log
+    def dumpFrameTrace(self, reason = "requested"):
+        if self.trace:
+            self.trace.dump(reason)
+
+    # set the time series store (twcseries.SeriesStore) for sampling power and amps per TWC every heartbeat, None: no samples
+    def setSeries(self, series = None):
+        self.series = series
+
+    # set the session tracker (twcsessions.SessionTracker) for charging sessions per TWC, None: no sessions
+    def setSessions(self, sessions = None):
+        self.sessions = sessions
+
+    # set the metrics (twcmetrics.Metrics) for counting frames and timing updates, None to stop collecting
+    def setMetrics(self, metrics = None):
+        self.metrics = metrics
+
+    # reveived data (bytes, bytearray or memoryview) from TWC slaves over serial interface, copied once
+    def dataReceived(self, data):
+        if self.recorder:
+            self.recorder.recordReceived(data)
+        if self.metrics:
+            self.metrics.frameReceived(data)
+        with self.lock:
+            self.receivedSendCount = self.sendCount
+            self.frameDecoder.feed(data)
+
+    # get the total current in use by all devices on one phase
+    def getTotalAmps(self):
+        return self.totalAmps
+
+    # Get the total charging current
+    def getTotalChargingAmps(self):
+        return self.totalChargingAmps
+
+    # Get the available current for TWCs
+    def getTWCTotalAvailableAmps(self):
+        return self.twcTotalAvailableAmps
+
+    # set max number of slaves, when exceeded the oldest slave is dropped
+    def setMaxSlaves(self, count):
+        self.maxSlaves = max(count, 1)
+
+    # get TWC slave by id, None when unknown
+    def getTWC(self, twcId):
+        return self.twcs.get(twcId)
+
+    # get all TWC data in one pass, sorted by twcId
+    # returns an array with SNAPSHOTFIELDS values per TWC: twcId, actualAmps, setAmps, power, totalKwh
+    # the array is reused by the next call, it is only reallocated when the number of slaves changes
+    def getTWCsSnapshot(self):
+        if self.twcOrder == None:
+            self.twcOrder = [self.twcs[twcId] for twcId in sorted(self.twcs)]
+            self.snapshot = array("d", bytes(8 * SNAPSHOTFIELDS * len(self.twcOrder)))
+        snapshot = self.snapshot
+        i = 0
+        for twc in self.twcOrder:
+            snapshot[i] = twc.twcId
+            snapshot[i + 1] = twc.actualAmps
+            snapshot[i + 2] = twc.setAmps
+            snapshot[i + 3] = twc.actualPower
+            snapshot[i + 4] = twc.totalKwh + twc.calculatedWatts / 1000.0
+            i += SNAPSHOTFIELDS
+        return snapshot
+
+    # Get actual TWC currents
+    def getTWCsActualAmps(self):
+        res = {}
+        for twc in self.twcs.values():
+            res[twc.twcId] = twc.actualAmps
+        return res
+
+    # Get actual TWC amps setting
+    def getTWCsSetAmps(self):
+        res = {}
+        for twc in self.twcs.values():
+            res[twc.twcId] = twc.setAmps
+        return res
+
+    # get the calculated charging power per TWC in watts
+    def getTWCsPower(self):
+        res = {}
+        for twc in self.twcs.values():
+            res[twc.twcId] = twc.actualPower
+        return res
+
+    # Get total Kwh per TWC
+    def getTWCsTotalKwh(self):
+        res = {}
+        for twc in self.twcs.values():
+            res[twc.twcId] = twc.totalKwh + twc.calculatedWatts / 1000.0
+        return res
+
+    # return number of active = charging TWCs
+    def getActiveTWCs(self):
+        count = 0
+        for twc in self.twcs.values():
+            if (twc.isActive()):
+                count += 1
+        return count
+
+    # calculate the desired current per TWC, per phase
+    #     current in use per phase = power per phase / volts per phase
+    #     current in use by other devices = current in use - current of the twc's on the phase
+    #     available for twc's per phase = total max current - other devices current on the phase
+    #     the allocator shares the available current per phase between the twc's
+    #     with a site budget the twc's of all masters are subtracted and the available current is shared
+    def calcDesiredAmps(self, now = None):
+        if now == None:
+            now = self.clock()
+        # the lowest voltage is used for phases without volts
+        volts = self.actualVolts
+        volt = volts[0]
+        for v in volts:
+            if (v > 0 and v < volt):
+                volt = v
+
+        # current per phase in use by all devices
+        power = self.actualTotalPower
+        phases = min(len(power), MAXPHASES)
+        phaseAmps = [0.0] * phases
+        for i in range(phases):
+            v = volts[i] if (i < len(volts) and volts[i] > 0) else volt
+            phaseAmps[i] = power[i] / v
+
+        # current per phase in use by the twc's and active twc's per phase
+        phaseChargingAmps = [0.0] * phases
+        phaseTWCs = [0] * phases
+        activeTWCs = 0
+        for twc in self.twcs.values():
+            active = twc.isActive()
+            if active:
+                activeTWCs += 1
+            for i in twc.phases:
+                if i < phases:
+                    phaseChargingAmps[i] += twc.actualAmps
+                    if active:
+                        phaseTWCs[i] += 1
+
+        # max amps in use per phase, phaseChargingAmps and activeTWCs are read by the site budget
+        self.phaseAmps = phaseAmps
+        self.phaseChargingAmps = phaseChargingAmps
+        self.activeTWCs = activeTWCs
+        self.totalAmps = max(phaseAmps)
+        self.totalChargingAmps = max(phaseChargingAmps)
+
+        if self.site:
+            totalMaxAmps = min(self.totalMaxAmps, self.site.totalMaxAmps)
+        else:
+            totalMaxAmps = self.totalMaxAmps
+
+        if self.metrics:
+            self.metrics.powerAge.observe(now - self.actualTolalPowerChanged)
+        phaseAvailableAmps = [0.0] * phases
+        maxTWCsAmps = min(self.twcsTotalMaxAmps, self.scheduledMaxAmps)
+        # check if actualTotalPower has been updated the last TIMETOSAVEMODE seconds
+        if (self.actualTolalPowerChanged > now - TIMETOSAVEMODE):
+            site = self.site
+            forecasts = self.otherAmpsForecast
+            for i in range(phases):
+                # apms in use for other devices, twc's of other masters are not other devices
+                if site:
+                    actualOtherDevicesAmps = phaseAmps[i] - site.getPhaseChargingAmps(i)
+                else:
+                    actualOtherDevicesAmps = phaseAmps[i] - phaseChargingAmps[i]
+                if forecasts:
+                    # use the forecast of the others amps for the ramp horizon
+                    forecast = forecasts[i]
+                    forecast.push(actualOtherDevicesAmps, now)
+                    available = totalMaxAmps - forecast.forecast()
+                else:
+                    # use the higest others amps history values for calculating the available amps for twcs
+                    hist = self.otherAmpsHist[i]
+                    hist.push(actualOtherDevicesAmps, now)
+                    available = totalMaxAmps - hist.max()
+                if site:
+                    available = site.getShare(self, min(available, site.twcsTotalMaxAmps))
+                if available > maxTWCsAmps:
+                    available = maxTWCsAmps
+                phaseAvailableAmps[i] = available if available > 0 else 0
+            # solar mode: never more than the surplus
+            if self.solar:
+                twcPhases = set()
+                for twc in self.twcs.values():
+                    twcPhases.update(twc.phases)
+                amps = self.solar.update(power, self.actualTolalPowerChanged, volt, len(twcPhases), self.totalChargingAmps, maxTWCsAmps)
+                for i in range(phases):
+                    if amps < phaseAvailableAmps[i]:
+                        phaseAvailableAmps[i] = amps
+        else:
+            # when no actual current reading is available use save mode setting
+            phaseAvailableAmps = [max(min(TWCMINAMPS, maxTWCsAmps), 0)] * phases
+            logging.error("No actualTotalPower received, use TWCMINAMPS: %d", TWCMINAMPS)
+        self.phaseAvailableAmps = phaseAvailableAmps
+
+        # total available for TWCs: the lowest phase with twc's, the lowest phase when no twc's
+        availableForTWCs = None
+        for i in range(phases):
+            if (phaseTWCs[i] > 0) and ((availableForTWCs == None) or (phaseAvailableAmps[i] < availableForTWCs)):
+                availableForTWCs = phaseAvailableAmps[i]
+        if availableForTWCs == None:
+            availableForTWCs = min(phaseAvailableAmps)
+        if (math.trunc(self.twcTotalAvailableAmps) != math.trunc(availableForTWCs)):
+            logging.info("Actual total: %.2f available: %.2f charging: %.2f", self.totalAmps, availableForTWCs, self.totalChargingAmps)
+        self.twcTotalAvailableAmps = availableForTWCs
+
+        # TWC current settings
+        self.allocator.allocate(self, phaseAvailableAmps, now)
+
+        logging.debug("Available per phase=%s ActiveTWCs per phase=%s", phaseAvailableAmps, phaseTWCs)
+
+    # send message to slaves, the message is queued and send in the next free bus slot
+    def sendMsg(self, msg):
+        if msg == None:
+            return
+        self.sendFrame(encodeFrame(msg))
+
+    # send framed message to slaves, the frame is queued and send in the next free bus slot
+    def sendFrame(self, data):
+        if data == None:
+            return
+        with self.sendLock:
+            self.sendQueue.append(data)
+            if self.metrics:
+                self.metrics.frameQueued(self.clock())
+        self.sendQueued()
+
+    # release queued messages, called from receive callbacks
+    def processSendQueue(self):
+        if self.recorder:
+            self.recorder.recordSendQueue()
+        self.sendQueued()
+
+    # release queued messages to the serial interface, one message per MSGSLEEP bus slot
+    # called by the send timer, the heartbeat and processSendQueue
+    def sendQueued(self):
+        with self.sendLock:
+            now = self.clock()
+            if self.sendQueue and (now >= self.nextSendTime):
+                data = self.sendQueue.popleft()
+                # give slave time to respond before the next message is send
+                self.nextSendTime = now + MSGSLEEP
+                self.sendCount += 1
+                if self.recorder:
+                    self.recorder.recordSent(data)
+                if self.metrics:
+                    self.metrics.frameSent(data, now)
+                if self.trace:
+                    self.trace.add(now, "send", data)
+                #send to serial interface
+                if self.sendDataCallback:
+                    self.sendDataCallback(data)
+                else:
+                    logging.error("sendDataCallback not defined, can not send data out:%s", binascii.hexlify(data))
+            # schedule the next slot when messages are waiting
+            if self.sendQueue and (self.sendTimer == None):
+                delay = max(self.nextSendTime - now, 0.0)
+                if self.sendTimerCallback:
+                    self.sendTimer = True
+                    self.sendTimerCallback(delay, self.onSendTimer)
+                else:
+                    self.sendTimer = threading.Timer(delay, self.onSendTimer)
+                    self.sendTimer.daemon = True
+                    self.sendTimer.start()
+
+    # a slave answered: when the answer was received after the last message the bus is free,
+    # the next message does not have to wait for the end of the slot
+    def answerReceived(self, now):
+        with self.sendLock:
+            if (self.receivedSendCount == self.sendCount) and (self.nextSendTime > now):
+                self.nextSendTime = now
+
+    # send timer expired: release the next message
+    def onSendTimer(self):
+        if self.recorder:
+            self.recorder.recordSendTimer()
+        with self.sendLock:
+            self.sendTimer = None
+        self.sendQueued()
+
+    # is the send queue empty
+    def isSendQueueEmpty(self):
+        with self.sendLock:
+            return len(self.sendQueue) == 0
+
+    # stop sending: clear the send queue and cancel the send timer
+    def stopSending(self):
+        if self.recorder:
+            self.recorder.recordStopSending()
+        with self.sendLock:
+            self.sendQueue.clear()
+            if self.metrics:
+                self.metrics.queueCleared()
+            if isinstance(self.sendTimer, threading.Timer):
+                self.sendTimer.cancel()
+            self.sendTimer = None
+
+    # get message from slaves, read received data and convert to message
+    # the message can be a memoryview on the receive buffer, valid until the next dataReceived
+    def recvMsg(self):
+        return self.frameDecoder.nextFrame()
+
+    # handle message reveived from slave
+    def handleRecvMsg(self, msg, now = None):
+        if now == None:
+            now = self.clock()
+        msglen = len(msg)
+        # the byte after the end of a frame is decoded as a one byte frame, it is not a message
+        if msglen <= 1:
+            return
+        metrics = self.metrics
+        if metrics:
+            metrics.framesIn += 1
+        trace = self.trace
+        if trace:
+            trace.add(now, "recv", msg)
+        if msglen < 14:
+            if metrics:
+                metrics.shortMsgs += 1
+            return
+
+        checksum = calcChecksum(msg, 1, msglen - 2)
+        msgchecksum = msg[msglen - 1]
+        if int(msgchecksum) != checksum:
+            if metrics:
+                metrics.checksumErrors += 1
+            logging.warn("recv message with wrong checksum: %s found %02x , expected: %02x", binascii.hexlify(msg), msgchecksum, checksum)
+            if trace:
+                trace.dumpOnError("checksum error", now)
+            return
+
+        msgtype = (msg[0] << 8) + msg[1]
+
+        if msgtype == 0xfde2:
+            # handle linkready from slave
+            sender = (msg[2] << 8) + msg[3]
+            # sign = msg[4]
+            amps = ((msg[5] << 8) + msg[6]) / 100.0
+            version = 1 if len(msg) == 14 else 2
+            logging.info("Linkready from slave: %04x %.2f", sender, amps)
+            # answer to the linkready of the master
+            self.answerReceived(now)
+            # if a slave has our id let it change his id
+            if sender == self.masterTWCId:
+                logging.info("Slave with same id as master, reinitialize to let slave choose new id")
+                self.initialized = False
+                return
+            # if twc already in list ignore linkready
+            if sender in self.twcs:
+                logging.debug("TWC(%04x) already in list", sender)
+                return
+            # create new twc and add it to the list
+            self.twcs[sender] = TWC(self, sender, amps, version, now, self.twcPhases.get(sender, ALLPHASES))
+            self.twcOrder = None
+            if len(self.twcs) > self.maxSlaves:
+                twc = self.twcs.pop(next(iter(self.twcs)))
+                logging.warn("Exceeded maxium number of slaves, dropped slave %04x", twc.twcId)
+
+        elif msgtype == 0xfde0:
+            #handle heartbeat from slave
+            sender = (msg[2] << 8) + msg[3]
+            receiver = (msg[4] << 8) + msg[5]
+            state = msg[6]
+            maxamps = ((msg[7] << 8) + msg[8]) / 100.0
+            chargeamps = ((msg[9] << 8) + msg[10]) / 100.0
+
+            if receiver != self.masterTWCId:
+                if metrics:
+                    metrics.unknownSlaves += 1
+                logging.warn("Heartbeat with unknown master: %04x received from %04x", receiver, sender)
+                return
+            # update twc data
+            twc = self.twcs.get(sender)
+            if twc:
+                twc.setDataFromTWC(state, maxamps, chargeamps, now)
+                self.answerReceived(now)
+            else:
+                if metrics:
+                    metrics.unknownSlaves += 1
+                logging.error("Unknown TWC Id: %04x", sender)
+
+        elif msgtype == 0xfdeb:
+            #handle kwh/volt message from slave
+            sender = (msg[2] << 8) + msg[3]
+            kwh = ((msg[4] << 24) + (msg[5] << 16) + (msg[6] << 8) + msg[7])
+            volts = [(msg[8] << 8) + msg[9], (msg[10] << 8) + msg[11], (msg[12] << 8) + msg[13]]
+
+            # update twc data
+            twc = self.twcs.get(sender)
+            if twc:
+                twc.setKwhVoltsFromTWC(kwh, volts)
+                self.answerReceived(now)
+            else:
+                if metrics:
+                    metrics.unknownSlaves += 1
+                logging.error("Kwh/volts message with unknown TWC Id: %04x", sender)
+
+        else:
+            if metrics:
+                metrics.unknownMsgs += 1
+            logging.warn("Unknown message from slave: %s", binascii.hexlify(msg))
+            if trace:
+                trace.dumpOnError("unknown message", now)
+
+    # handle all complete messages received from slaves, returns the number of messages
+    # called from receive callbacks, update handles the received messages too
+    def handleReceived(self, now = None):
+        if self.recorder:
+            self.recorder.recordHandleReceived()
+        if now == None:
+            now = self.clock()
+        return self.handleMessages(now)
+
+    # handleReceived() without recording
+    def handleMessages(self, now):
+        count = 0
+        with self.lock:
+            msg = self.recvMsg()
+            while msg:
+                self.handleRecvMsg(msg, now)
+                count += 1
+                msg = self.recvMsg()
+        return count
+
+    # init Master: send linkready 1 and 2 messages
+    def initMaster(self):
+        masterTWCId = self.masterTWCId
+        linkready1 = bytearray([0xfc, 0xe1, (masterTWCId>>8) & 0xFF, masterTWCId & 0xFF, self.masterTWCSign, 0x00,0x00,0x00,0x00,0x00,0x00,0x00,0x00])
+        linkready2 = bytearray([0xfb, 0xe2, (masterTWCId>>8) & 0xFF, masterTWCId & 0xFF, self.masterTWCSign, 0x00,0x00,0x00,0x00,0x00,0x00,0x00,0x00])
+        for _ in range (5):
+            self.sendMsg(linkready1)
+        for _ in range (5):
+            self.sendMsg(linkready2)
+
+    # update TWC's charging setting, the time is read once per update
+    def update(self, now = None):
+        if self.recorder:
+            self.recorder.recordUpdate()
+        if now == None:
+            now = self.clock()
+        self.runUpdate(now)
+
+    # update() without recording, called by setActualPower and the heartbeat
+    def runUpdate(self, now):
+        with self.lock:
+            if self.metrics:
+                start = time.perf_counter()
+                self.updateTWCs(now)
+                self.metrics.observeTick(time.perf_counter() - start)
+            else:
+                self.updateTWCs(now)
+
+    # update() without metrics
+    def updateTWCs(self, now):
+
+        # init Master
+        if not self.initialized:
+            self.initMaster()
+            self.initialized = True
+            return
+
+        # check incomming messages
+        self.handleMessages(now)
+
+        # do the calculations and set the TWCs desiredAmps
+        self.calcDesiredAmps(now)
+
+        # remove twcs that don't send haertbeats to master
+        for twc in [twc for twc in self.twcs.values() if twc.isDead(now)]:
+            del self.twcs[twc.twcId]
+            self.twcOrder = None
+            logging.warn("No heartbeats receveid from slave, deleted slave %04x", twc.twcId)
+
+        # previous heartbeats not send yet, bus is busy: skip this round
+        if not self.isSendQueueEmpty():
+            logging.debug("Send queue not empty, skip heartbeats")
+            return
+
+        # send heartbeat to slave(s)
+        metrics = self.metrics
+        for twc in self.twcs.values():
+            setAmps = twc.setAmps
+            self.sendFrame(twc.getHeartBeatFrame(now))
+            if metrics and twc.setAmps != setAmps:
+                metrics.setpointLatency.observe(now - self.actualTolalPowerChanged)
+
+    # call this method every second to do the processing
+    def handleHeartBeat(self):
+        if self.recorder:
+            self.recorder.recordHeartBeat()
+        # release queued messages when the send timer is not running
+        self.sendQueued()
+        # when update is not triggered by setactualTotalPower do it here
+        now = self.clock()
+        with self.lock:
+            if (self.actualTolalPowerChanged < now - 2):
+                logging.debug("Update handled by heartbeat")
+                self.runUpdate(now)
+            # sample power and amps
+            if self.series:
+                self.series.sample(self, now)
+            # charging sessions
+            if self.sessions:
+                self.sessions.update(self, now)
+            # save state
+            if self.stateFile and (now >= self.nextStateSave):
+                self.nextStateSave = now + STATESAVEINTERVAL
+                self.saveState()
+
+
+# Site budget shared by the masters on one network connection (one P1 meter)
+# the twc's of all masters are not counted as other devices, and the current available for
+# all twc's is shared between the masters by their number of active twc's
+# masters can run on their own threads: a master reads the values the other masters published in their last calculation
+class SiteBudget:
+    def __init__(self, totalMaxAmps = TotalMaxAmps, twcsTotalMaxAmps = TWCsTotalMaxAmps):
+        self.totalMaxAmps = totalMaxAmps            # total max network amps
+        self.twcsTotalMaxAmps = min(twcsTotalMaxAmps, totalMaxAmps)  # max total current for the twc's of all masters
+        self.masters = []
+
+    # add master to this site
+    def addMaster(self, master):
+        master.site = self
+        self.masters.append(master)
+
+    # total current for the twc's of all masters
+    def getTotalChargingAmps(self):
+        amps = 0.0
+        for master in self.masters:
+            with master.lock:
+                for twc in master.twcs.values():
+                    amps += twc.actualAmps
+        return amps
+
+    # current on phase for the twc's of all masters, at their last calculation
+    def getPhaseChargingAmps(self, phase):
+        amps = 0.0
+        for master in self.masters:
+            phaseChargingAmps = master.phaseChargingAmps
+            if phase < len(phaseChargingAmps):
+                amps += phaseChargingAmps[phase]
+        return amps
+
+    # part of the available current for the master, by number of active twc's at the last calculation (at least 1 per master)
+    def getShare(self, master, available):
+        total = 0
+        for m in self.masters:
+            total += max(m.activeTWCs, 1)
+        return available * max(master.activeTWCs, 1) / max(total, 1)
+
+    # actual total power for all masters, set in powerchange event, each master updates holding its own lock
+    def setActualPower(self, power):
+        for master in self.masters:
+            master.setActualPower(power)
+
+    # set actual volts for all masters
+    def setActualVolts(self, volts):
+        for master in self.masters:
+            master.setActualVolts(volts)
+
+
+# default master used by the module level functions
+master = TWCMaster()
+
+# state of the default master that scripts read as module globals (twcmaster.totalAmps), read only
+MASTERSTATE = ("initialized", "masterTWCId", "masterTWCSign", "sendDataCallback", "scheduledMaxAmps", "actualTotalPower",
+               "actualTolalPowerChanged", "actualVolts", "totalAmps", "totalChargingAmps", "twcTotalAvailableAmps")
+
+
+# module globals of the default master: the MASTERSTATE values and twcList, the TWC slaves in order of linkready
+def __getattr__(name):
+    if name in MASTERSTATE:
+        return getattr(master, name)
+    if name == "twcList":
+        return list(master.twcs.values())
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
 
 # set config parameters
 def setConfig(totalmax, twctotal, twc, level, file):
@@ -241,8 +1672,8 @@ def setConfig(totalmax, twctotal, twc, level, file):
     global LogLevel
     global LogFile
     TotalMaxAmps = totalmax
-    TWCsTotalMaxAmps = min(twctotal, TotalMaxAmps)
-    TWCMaxAmps = min(twc, TWCsTotalMaxAmps)
+    TWCsTotalMaxAmps = twctotal
+    TWCMaxAmps = twc
     LogLevel = level
     LogFile = file
 
@@ -255,385 +1686,214 @@ def setConfig(totalmax, twctotal, twc, level, file):
     logger = logging.getLogger()
     logger.addHandler(log_handler)
     logger.setLevel(LogLevel)
-    logging.info("Set max currents, Total all devices:%.2f Total TWC:%.2f Single TWC:%.2f", totalmax, twctotal, twc)
+    master.setConfig(totalmax, twctotal, twc)
 
 
 # Scheduled max current for all TWCs, set in scheduletwc event
 def setScheduledMaxAmps(amps):
-    global scheduledMaxAmps
-    amps = math.trunc(min(amps, TWCsTotalMaxAmps))
-    if (amps != scheduledMaxAmps):
-        scheduledMaxAmps = amps
-        logging.info("ScheduledMaxAmps changed to: %.2f", amps)
+    master.setScheduledMaxAmps(amps)
+
+
+# set the window for the amps in use by other devices history
+def setOtherAmpsHistory(maxCount, maxAge = 0):
+    master.setOtherAmpsHistory(maxCount, maxAge)
+
+
+# set the forecast for the amps in use by other devices, None: use the highest value in the history
+def setOtherAmpsForecast(forecast = None):
+    master.setOtherAmpsForecast(forecast)
+
+
+# set the allocator that shares the available amps between the twc's, None: EvenAllocator
+def setAllocator(allocator = None):
+    master.setAllocator(allocator)
+
+
+# set solar mode (SolarController), None: off
+def setSolarMode(solar = None):
+    master.setSolarMode(solar)
+
+
+# set the phases (0..2) a TWC is wired to
+def setTWCPhases(twcId, phases = ALLPHASES):
+    master.setTWCPhases(twcId, phases)
 
 
 # set actual volts from power supply, used for calculating twc power
 def setActualVolts(volts):
-    global actualVolts
-    actualVolts = volts
+    master.setActualVolts(volts)
 
 
 # Actual total power in use, set in powerchange event
 def setActualPower(power):
-    global actualTotalPower
-    global actualTolalPowerChanged
-    actualTolalPowerChanged = time.time()
-    actualTotalPower = power
-    # update charging settings
-    update()
+    master.setActualPower(power)
+
+
+# set the clock: function returning the time in seconds
+def setClock(clock = time.time):
+    master.setClock(clock)
 
 
 # set the method callback(bytearray) to call for sending data to TWC slaves over serial interface
 def setSendDataCallback(callback = None):
-    global sendDataCallback
-    sendDataCallback = callback
+    master.setSendDataCallback(callback)
+
+
+# set the method callback(delay, func) used to call func after delay seconds for releasing queued messages
+def setSendTimerCallback(callback = None):
+    master.setSendTimerCallback(callback)
+
+
+# handle all complete messages received from slaves, returns the number of messages
+def handleReceived():
+    return master.handleReceived()
+
+
+# set the wire recorder for recording all data in and out
+def setRecorder(recorder = None):
+    master.setRecorder(recorder)
+
+
+# set the file for saving the state every STATESAVEINTERVAL seconds
+def setStateFile(path = None):
+    master.setStateFile(path)
+
+
+# save the state to the state file
+def saveState():
+    return master.saveState()
+
+
+# load the state from the state file, returns True when the state is used
+def loadState():
+    return master.loadState()
+
+
+# set the frame trace size and max frames per second, size 0 disables the trace
+def setFrameTrace(size = TRACESIZE, rate = TRACERATE):
+    master.setFrameTrace(size, rate)
+
+
+# write the frame trace to the log
+def dumpFrameTrace(reason = "requested"):
+    master.dumpFrameTrace(reason)
+
+
+# set the time series store (twcseries.SeriesStore), None: no samples
+def setSeries(series = None):
+    master.setSeries(series)
+
+
+# set the session tracker (twcsessions.SessionTracker), None: no sessions
+def setSessions(sessions = None):
+    master.setSessions(sessions)
+
+
+# set the metrics (twcmetrics.Metrics), None to stop collecting
+def setMetrics(metrics = None):
+    master.setMetrics(metrics)
+
+
+# get the metrics snapshot, None when no metrics are set
+def getMetrics():
+    if master.metrics:
+        return master.metrics.snapshot(master)
+    return None
 
 
 # reveived data (bytearray) from TWC slaves over serial interface
 def dataReceived(data):
-    dataIn.extend(data)
+    master.dataReceived(data)
 
 
 # get the total current in use by all devices on one phase
 def getTotalAmps():
-    return totalAmps
+    return master.getTotalAmps()
 
 
 # Get the total charging current
 def getTotalChargingAmps():
-    return totalChargingAmps
+    return master.getTotalChargingAmps()
 
 
 # Get the available current for TWCs
 def getTWCTotalAvailableAmps():
-    return twcTotalAvailableAmps
+    return master.getTWCTotalAvailableAmps()
 
 
 # Get actual TWC currents
 def getTWCsActualAmps():
-    res = {}
-    for twc in twcList:
-        res[twc.twcId] = twc.actualAmps
-    return res
+    return master.getTWCsActualAmps()
 
 
 # Get actual TWC amps setting
 def getTWCsSetAmps():
-    res = {}
-    for twc in twcList:
-        res[twc.twcId] = twc.setAmps
-    return res
+    return master.getTWCsSetAmps()
 
 
 # get the calculated charging power per TWC in watts
 def getTWCsPower():
-    res = {}
-    for twc in twcList:
-        res[twc.twcId] = twc.actualPower
-    return res
+    return master.getTWCsPower()
 
 
 # Get total Kwh per TWC
 def getTWCsTotalKwh():
-    res = {}
-    for twc in twcList:
-        res[twc.twcId] = twc.totalKwh + twc.calculatedWatts / 1000.0
-    return res
+    return master.getTWCsTotalKwh()
 
 
-# return number of active = charging TWCs
-def getActiveTWCs():
-    count = 0
-    for twc in twcList:
-        if (twc.isActive()):
-            count += 1
-    return count
+# get all TWC data in one pass: array with SNAPSHOTFIELDS values per TWC sorted by twcId
+def getTWCsSnapshot():
+    return master.getTWCsSnapshot()
 
 
-# calculate the desired current per TWC
-#     calculate power used by other devices from total power in use, minus total power in use by twc's
-#     asume other devices are on the same phase (to be sure, we don't know)
-#     current in use by other devices = (total power - twc power) / volts per phase
-#     available for twc's = total max current - other devices current
-def calcDesiredAmps():
-    global totalAmps
-    global totalChargingAmps
-    global twcTotalAvailableAmps
-
-    # use the lowest voltage and highest power to calc amps = power/volt
-    volt = actualVolts[0]
-    for v in actualVolts:
-        if (v > 0 and v < volt):
-            volt = v
-
-    # get Total current and power in use by all wall connectors
-    actualTotalTWCsAmps = 0.0
-    actualTotalTWCsPower = 0.0
-    for twc in twcList:
-        actualTotalTWCsAmps += twc.actualAmps
-        actualTotalTWCsPower += twc.actualPower
-
-    # Total amps per phase in use by all twcs
-    totalChargingAmps = actualTotalTWCsAmps
-
-    # max amps in use per phase
-    totalAmps = max(actualTotalPower) / volt
-
-    # apms in use per phase for other devices
-    actualOtherDevicesAmps = totalAmps - totalChargingAmps
-
-    # check if actualTotalPower has been updated the last TIMETOSAVEMODE seconds
-    if (actualTolalPowerChanged > time.time() - TIMETOSAVEMODE):
-        # use the higest others amps history values for calculating the available amps for twcs
-        otherAmpsHistList.append(actualOtherDevicesAmps)
-        if len(otherAmpsHistList) > otherAmpsHistMaxCount:
-            otherAmpsHistList.pop(0)
-        availableForTWCs = min(TotalMaxAmps - max(otherAmpsHistList), TWCsTotalMaxAmps, scheduledMaxAmps)
-    else:
-        # when no actual current reading is available use save mode setting
-        availableForTWCs = min(TWCMINAMPS, TWCsTotalMaxAmps, scheduledMaxAmps)
-        logging.error("No actualTotalPower received, use TWCMINAMPS: %d", TWCMINAMPS)
-
-    # get active TWCs eq are charging or ready to charge, use 1 when none
-    numOfTWCs = max(getActiveTWCs(), 1)
-    # total available for TWCs
-    availableForTWCs = max(availableForTWCs, 0)
-    if (math.trunc(twcTotalAvailableAmps) != math.trunc(availableForTWCs)):
-        logging.info("Actual total: %.2f available: %.2f charging: %.2f", totalAmps, availableForTWCs, totalChargingAmps)
-    twcTotalAvailableAmps = availableForTWCs
-    # current available per TWC
-    availablePerTWC = min(availableForTWCs / numOfTWCs, TWCMaxAmps)
-    # TWC current setting
-    amps = math.trunc(max(availablePerTWC, 0))
-    for twc in twcList:
-        twc.desiredAmps = amps
-
-    logging.debug("AvailableForTWCs=%.2f ActiveTWCs=%d Desired amps=%d" , availableForTWCs, numOfTWCs, amps)
+# set max number of slaves
+def setMaxSlaves(count):
+    master.setMaxSlaves(count)
 
 
-# get checksum for message
-def calcChecksum(msg, start, end):
-    checksum = 0
-    for i in range(start, end):
-        checksum += msg[i]
-    return checksum & 0xFF
+# return number of active = charging TWCs
+def getActiveTWCs():
+    return master.getActiveTWCs()
 
 
-# escape msg data
-def escapeData(msg):
-    data = bytearray([])
-    for b in msg:
-        if b == 0xc0:
-            #escape c0 with dbdc
-            data.append(0xdb)
-            data.append(0xdc)
-        elif b == 0xdb:
-            #escape db with dbdd
-            data.append(0xdb)
-            data.append(0xdd)
-        else:
-            data.append(b)
-    return data
+# stop sending: clear the send queue and cancel the send timer
+def stopSending():
+    master.stopSending()
 
 
-# unescape msg data
-def unescapeData(msg):
-    data = bytearray([])
-    escfound = False
-    for b in msg:
-        if escfound:
-            if b == 0xdc:
-                data.append(0xc0)
-            elif b == 0xdd:
-                data.append(0xdb)
-            else:
-                data.append(b)
-                logging.error("Unknown escape byte sequence 0xdb %02x", b)
-            escfound = False
-        else:
-            if b == 0xdb:
-                escfound = True
-            else:
-                data.append(b)
-    return data
+# calculate the desired current per TWC
+def calcDesiredAmps():
+    master.calcDesiredAmps()
 
 
-# send message to slaves
+# send message to slaves, the message is queued and send in the next free bus slot
 def sendMsg(msg):
-    if msg == None:
-        return
-    # add checksum
-    msgdata = bytearray(msg)
-    checksum = calcChecksum(msgdata, 1, len(msgdata))
-    msgdata.extend(bytearray([checksum]))
-    logging.debug("send:%s", binascii.hexlify(msgdata))
-    # escape message data
-    msgdata = escapeData(msgdata)
-    # add pre and postfix
-    data = bytearray([0xc0])
-    data.extend(msgdata)
-    data.extend(bytearray([0xc0,0xfe]))
-    #send to serial interface
-    if sendDataCallback:
-        sendDataCallback(data)
-    else:
-        logging.error("sendDataCallback not defined, can not send data out:%s", binascii.hexlify(data))
-    # give slave time to respond
-    time.sleep(MSGSLEEP)
+    master.sendMsg(msg)
 
 
-# get message from slaves, read dataIn and convert to message
+# get message from slaves, None when no complete message has been received
 def recvMsg():
-    # find message between two 0xc0 bytes
-    start = dataIn.find(b"\xc0")
-    if start < 0:
-        return None
-    end = dataIn.find(b"\xc0", start + 1)
-    if (end-start == 1):
-        start = end
-        end = dataIn.find(b"\xc0", start + 1)
-    if end < 0:
-        return None
-    # discard data until start
-    for _ in range(start+1):
-        dataIn.pop(0)
-    # pop message
-    msg = bytearray([])
-    for _ in range(end-start-1):
-        msg.append(dataIn.pop(0))
-    # return unescaped data
-    return unescapeData(msg)
+    return master.recvMsg()
 
 
 # handle message reveived from slave
 def handleRecvMsg(msg):
-    global initialized
-
-    msglen = len(msg)
-    if msglen < 14:
-        if msglen > 1:
-            logging.debug("recv message to short: %s", binascii.hexlify(msg))
-        return
-
-    checksum = calcChecksum(msg, 1, msglen - 2)
-    msgchecksum = msg[msglen - 1]
-    if int(msgchecksum) != checksum:
-        logging.warn("recv message with wrong checksum: %s found %02x , expected: %02x", binascii.hexlify(msg), msgchecksum, checksum)
-        return
-
-    logging.debug("recv:%s", binascii.hexlify(msg))
-
-    msgtype = (msg[0] << 8) + msg[1]
-
-    if msgtype == 0xfde2:
-        # handle linkready from slave
-        sender = (msg[2] << 8) + msg[3]
-        # sign = msg[4]
-        amps = ((msg[5] << 8) + msg[6]) / 100.0
-        version = 1 if len(msg) == 14 else 2
-        logging.info("Linkready from slave: %04x %.2f", sender, amps)
-        # if a slave has our id let it change his id
-        if sender == masterTWCId:
-            logging.info("Slave with same id as master, reinitialize to let slave choose new id")
-            initialized = False
-            return
-        # if twc already in list ignore linkready
-        for twc in twcList:
-            if twc.twcId == sender:
-                logging.debug("TWC(%04x) already in list", sender)
-                return
-        # create new twc and add it to the list
-        newtwc = TWC(sender, amps, version)
-        twcList.append(newtwc)
-        if len(twcList) > MAXSLAVES:
-            twc = twcList.pop(0)
-            logging.warn("Exceeded maxium number of slaves, dropped slave %04x", twc.twcId)
-
-    elif msgtype == 0xfde0:
-        #handle heartbeat from slave
-        sender = (msg[2] << 8) + msg[3]
-        receiver = (msg[4] << 8) + msg[5]
-        state = msg[6]
-        maxamps = ((msg[7] << 8) + msg[8]) / 100.0
-        chargeamps = ((msg[9] << 8) + msg[10]) / 100.0
-        logging.debug("Heartbeat from slave: slave:%04x master:%04x state:%d set:%.2f cur:%.2f", sender, receiver, state, maxamps, chargeamps)
-
-        if receiver != masterTWCId:
-            logging.warn("Heartbeat with unknown master: %04x received from %04x", receiver, sender)
-            return
-        # update twc data
-        for twc in twcList:
-            if twc.twcId == sender:
-                twc.setDataFromTWC(state, maxamps, chargeamps)
-                break
-        else:
-            logging.error("Unknown TWC Id: %04x", sender)
-
-    elif msgtype == 0xfdeb:
-        #handle kwh/volt message from slave
-        sender = (msg[2] << 8) + msg[3]
-        kwh = ((msg[4] << 24) + (msg[5] << 16) + (msg[6] << 8) + msg[7])
-        volts = [(msg[8] << 8) + msg[9], (msg[10] << 8) + msg[11], (msg[12] << 8) + msg[13]]
-        logging.debug("Kwh/volts from slave: slave:%04x kwh:%d v1:%d v2:%d v3:%d", sender, kwh, volts[0], volts[1], volts[2])
-
-        # update twc data
-        for twc in twcList:
-            if twc.twcId == sender:
-                twc.setKwhVoltsFromTWC(kwh, volts)
-                break
-        else:
-            logging.error("Kwh/volts message with unknown TWC Id: %04x", sender)
-
-    else:
-        logging.warn("Unknown message from slave: %s", binascii.hexlify(msg))
+    master.handleRecvMsg(msg)
 
 
 # init Master: send linkready 1 and 2 messages
 def initMaster():
-    linkready1 = bytearray([0xfc, 0xe1, (masterTWCId>>8) & 0xFF, masterTWCId & 0xFF, masterTWCSign, 0x00,0x00,0x00,0x00,0x00,0x00,0x00,0x00])
-    linkready2 = bytearray([0xfb, 0xe2, (masterTWCId>>8) & 0xFF, masterTWCId & 0xFF, masterTWCSign, 0x00,0x00,0x00,0x00,0x00,0x00,0x00,0x00])
-    for _ in range (5):
-        sendMsg(linkready1)
-    for _ in range (5):
-        sendMsg(linkready2)
+    master.initMaster()
 
 
 # update TWC's charging setting
 def update():
-    global initialized
-
-    # init Master
-    if not initialized:
-        initMaster()
-        initialized = True
-        return
-
-    # check incomming messages
-    msg = recvMsg()
-    while msg:
-        handleRecvMsg(msg)
-        msg = recvMsg()
-
-    # do the calculations and set the TWCs desiredAmps
-    calcDesiredAmps()
-
-    # remove twcs that don't send haertbeats to master
-    for twc in twcList:
-        if twc.isDead():
-            twcList.remove(twc)
-            logging.warn("No heartbeats receveid from slave, deleted slave %04x", twc.twcId)
-
-    # send heartbeat to slave(s)
-    for twc in twcList:
-        sendMsg(twc.getHeartBeatMsg())
+    master.update()
 
 
 # call this method every second to do the processing
 def handleHeartBeat():
-    # when update is not triggered by setactualTotalPower do it here
-    if (actualTolalPowerChanged < time.time() - 2):
-        logging.debug("Update handled by heartbeat")
-        update()
+    master.handleHeartBeat()
 
 
 #FOR TEST ONLY
@@ -652,4 +1912,5 @@ def speedup4Testing():
     TIMETODELTWC = 5
     MSGSLEEP = 0.1
     otherAmpsHistMaxCount = 1
+    master.setOtherAmpsHistory(otherAmpsHistMaxCount)
     STARTCHARGETIME = 0
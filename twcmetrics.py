@@ -0,0 +1,196 @@
+#
+# TWC metrics
+# Counters and histograms for a TWCMaster, set with TWCMaster.setMetrics()
+# snapshot() returns a dict, prometheusText() the Prometheus text format, startHttpServer() serves it on /metrics
+# collecting is a few integer additions per frame and a bisect per histogram sample, nothing is formatted in the loop
+#
+import bisect
+import threading
+import collections
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    BaseHTTPRequestHandler = HTTPServer = None
+
+HTTPPORT = 9101             # default port of the metrics http server
+
+# histogram bucket upper bounds in seconds
+TICKBUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1)
+WAITBUCKETS = (0.01, 0.1, 0.2, 0.4, 0.8, 1.6, 3.2, 6.4)
+AGEBUCKETS = (0.5, 1.0, 2.0, 3.0, 5.0, 10.0, 30.0, 60.0)
+
+
+# histogram with fixed buckets, counts[i] is the number of values <= bounds[i], the last count is +Inf
+class Histogram:
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    # mean of all values, 0 when empty
+    def mean(self):
+        return self.sum / self.count if self.count else 0.0
+
+    # cumulative counts as [(bound, count)], bound None is +Inf
+    def cumulative(self):
+        result = []
+        total = 0
+        for bound, count in zip(self.bounds + (None,), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+# metrics of one master
+class Metrics:
+    def __init__(self):
+        # counters
+        self.ticks = 0                              # update() calls
+        self.framesIn = 0                           # messages received from slaves
+        self.framesOut = 0                          # frames send to serial interface
+        self.bytesIn = 0                            # bytes received from serial interface
+        self.bytesOut = 0                           # bytes send to serial interface
+        self.checksumErrors = 0                     # messages with wrong checksum
+        self.shortMsgs = 0                          # messages to short to handle
+        self.unknownMsgs = 0                        # messages with unknown type
+        self.unknownSlaves = 0                      # messages from slaves not linked to this master
+        self.droppedFrames = 0                      # queued frames cleared by stopSending
+        # histograms
+        self.tickDuration = Histogram(TICKBUCKETS)  # seconds per update()
+        self.sendWait = Histogram(WAITBUCKETS)      # seconds a frame waits for a free bus slot
+        self.powerAge = Histogram(AGEBUCKETS)       # age of actualTotalPower when the desired amps are calculated
+        self.setpointLatency = Histogram(AGEBUCKETS)  # seconds from power change to a changed set amps send to a slave
+        self.queued = collections.deque()           # queue times of the frames in the send queue
+        self.lock = threading.Lock()                # protects queued, frames are queued and send from different threads
+
+    # update() took seconds
+    def observeTick(self, seconds):
+        self.ticks += 1
+        self.tickDuration.observe(seconds)
+
+    def frameReceived(self, data):
+        self.bytesIn += len(data)
+
+    def frameQueued(self, now):
+        with self.lock:
+            self.queued.append(now)
+
+    def frameSent(self, data, now):
+        self.framesOut += 1
+        self.bytesOut += len(data)
+        with self.lock:
+            if self.queued:
+                self.sendWait.observe(now - self.queued.popleft())
+
+    def queueCleared(self):
+        with self.lock:
+            self.droppedFrames += len(self.queued)
+            self.queued.clear()
+
+    # counters, histograms and gauges read from master, cheap enough to call every heartbeat
+    # the gauges of the slaves and the receive buffer are read holding the master lock, the http server has its own thread
+    def snapshot(self, master):
+        now = master.clock()
+        with master.lock:
+            bytesBuffered = master.frameDecoder.pending()
+            heartbeatAge = dict((twc.twcId, now - twc.lastDataChanged) for twc in master.twcs.values())
+        histograms = {}
+        for name in ("tickDuration", "sendWait", "powerAge", "setpointLatency"):
+            h = getattr(self, name)
+            histograms[name] = {"count": h.count, "sum": h.sum, "buckets": h.cumulative()}
+        return {
+            "ticks": self.ticks,
+            "framesIn": self.framesIn,
+            "framesOut": self.framesOut,
+            "bytesIn": self.bytesIn,
+            "bytesOut": self.bytesOut,
+            "checksumErrors": self.checksumErrors,
+            "shortMsgs": self.shortMsgs,
+            "unknownMsgs": self.unknownMsgs,
+            "unknownSlaves": self.unknownSlaves,
+            "droppedFrames": self.droppedFrames,
+            "bytesBuffered": bytesBuffered,
+            "sendQueueLength": len(master.sendQueue),
+            "powerAge": now - master.actualTolalPowerChanged,
+            "heartbeatAge": heartbeatAge,
+            "histograms": histograms,
+        }
+
+    # Prometheus text exposition format
+    def prometheusText(self, master):
+        snapshot = self.snapshot(master)
+        lines = []
+        counters = (("ticks", "twc_ticks_total", "update() calls"),
+                    ("framesIn", "twc_frames_in_total", "messages received from slaves"),
+                    ("framesOut", "twc_frames_out_total", "frames send to slaves"),
+                    ("bytesIn", "twc_bytes_in_total", "bytes received"),
+                    ("bytesOut", "twc_bytes_out_total", "bytes send"),
+                    ("checksumErrors", "twc_checksum_errors_total", "messages with wrong checksum"),
+                    ("shortMsgs", "twc_short_messages_total", "messages to short to handle"),
+                    ("unknownMsgs", "twc_unknown_messages_total", "messages with unknown type"),
+                    ("unknownSlaves", "twc_unknown_slave_messages_total", "messages from unknown slaves"),
+                    ("droppedFrames", "twc_dropped_frames_total", "queued frames cleared"))
+        for key, name, help in counters:
+            lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s counter" % name)
+            lines.append("%s %d" % (name, snapshot[key]))
+        gauges = (("bytesBuffered", "twc_bytes_buffered", "received bytes not handled yet"),
+                  ("sendQueueLength", "twc_send_queue_length", "frames waiting for a bus slot"),
+                  ("powerAge", "twc_power_age_seconds", "seconds since the last power change"))
+        for key, name, help in gauges:
+            lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s gauge" % name)
+            lines.append("%s %g" % (name, snapshot[key]))
+        lines.append("# HELP twc_heartbeat_age_seconds seconds since the last heartbeat from the slave")
+        lines.append("# TYPE twc_heartbeat_age_seconds gauge")
+        for twcId, age in sorted(snapshot["heartbeatAge"].items()):
+            lines.append('twc_heartbeat_age_seconds{twc="%04x"} %g' % (twcId, age))
+        histograms = (("tickDuration", "twc_tick_duration_seconds", "duration of update()"),
+                      ("sendWait", "twc_send_wait_seconds", "time a frame waits for a bus slot"),
+                      ("powerAge", "twc_decision_power_age_seconds", "age of the power reading used for a decision"),
+                      ("setpointLatency", "twc_setpoint_latency_seconds", "power change to changed set amps"))
+        for key, name, help in histograms:
+            h = snapshot["histograms"][key]
+            lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s histogram" % name)
+            for bound, count in h["buckets"]:
+                lines.append('%s_bucket{le="%s"} %d' % (name, "+Inf" if bound == None else "%g" % bound, count))
+            lines.append("%s_sum %g" % (name, h["sum"]))
+            lines.append("%s_count %d" % (name, h["count"]))
+        return "\n".join(lines) + "\n"
+
+
+# serve the metrics of master on http://addr:port/metrics in a daemon thread, returns the HTTPServer
+# only listens on localhost by default
+def startHttpServer(master, port = HTTPPORT, addr = "127.0.0.1"):
+    if HTTPServer == None:
+        raise ImportError("http.server not available")
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics" or master.metrics == None:
+                self.send_error(404)
+                return
+            body = master.metrics.prometheusText(master).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        # no logging per request
+        def log_message(self, format, *args):
+            pass
+
+    server = HTTPServer((addr, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
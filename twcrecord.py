@@ -0,0 +1,194 @@
+#
+# TWC wire recorder and replay
+# Record all data received from and send to the TWC slaves, plus the master inputs, to an append-only binary log
+# and replay the log through a TWCMaster on a virtual clock, faster than real time
+#
+# record = time (double, monotonic seconds), type (byte), length (unsigned short), data
+#
+import sys
+import time
+import struct
+import difflib
+import logging
+import threading
+import twcmaster
+
+# record types
+RECEIVED = 1                # data received from serial interface
+SENT = 2                    # frame send to serial interface
+POWER = 3                   # actual total power per phase (doubles)
+VOLTS = 4                   # actual volts per phase (doubles)
+SCHEDULEDAMPS = 5           # scheduled max amps (double)
+HEARTBEAT = 6               # master heartbeat (handleHeartBeat), no data
+HANDLERECEIVED = 7          # received messages handled by a receive callback (handleReceived), no data
+SENDTIMER = 8               # send timer expired (onSendTimer), no data
+SENDQUEUE = 9               # queued messages released by a receive callback (processSendQueue), no data
+UPDATE = 10                 # update called by a callback (update), no data
+STOPSENDING = 11            # send queue cleared (stopSending), no data
+
+RECORDHEADER = struct.Struct("<dBH")
+
+
+# Wire recorder, set with TWCMaster.setRecorder()
+class WireRecorder:
+    def __init__(self, path, clock = time.monotonic):
+        self.file = open(path, "ab")
+        self.clock = clock
+        self.lock = threading.Lock()
+
+    # write one record
+    def record(self, recordType, data = b""):
+        with self.lock:
+            self.file.write(RECORDHEADER.pack(self.clock(), recordType, len(data)))
+            self.file.write(data)
+
+    def recordReceived(self, data):
+        self.record(RECEIVED, bytes(data))
+
+    def recordSent(self, data):
+        self.record(SENT, bytes(data))
+
+    def recordPower(self, power):
+        self.record(POWER, struct.pack("<%dd" % len(power), *power))
+
+    def recordVolts(self, volts):
+        self.record(VOLTS, struct.pack("<%dd" % len(volts), *volts))
+
+    def recordScheduledMaxAmps(self, amps):
+        self.record(SCHEDULEDAMPS, struct.pack("<d", amps))
+
+    def recordHeartBeat(self):
+        self.record(HEARTBEAT)
+
+    def recordHandleReceived(self):
+        self.record(HANDLERECEIVED)
+
+    def recordSendTimer(self):
+        self.record(SENDTIMER)
+
+    def recordSendQueue(self):
+        self.record(SENDQUEUE)
+
+    def recordUpdate(self):
+        self.record(UPDATE)
+
+    def recordStopSending(self):
+        self.record(STOPSENDING)
+
+    # write buffered records to file
+    def flush(self):
+        with self.lock:
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+# read all records from log: yields (time, type, data), a truncated last record is ignored
+def readRecords(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    offset = 0
+    while offset + RECORDHEADER.size <= len(data):
+        t, recordType, length = RECORDHEADER.unpack_from(data, offset)
+        offset += RECORDHEADER.size
+        if offset + length > len(data):
+            logging.warning("Truncated record at end of %s", path)
+            break
+        yield t, recordType, data[offset:offset + length]
+        offset += length
+
+
+# unpack doubles
+def unpackValues(data):
+    return list(struct.unpack("<%dd" % (len(data) // 8), data))
+
+
+# Replay result: frames send by the replayed master and frames in the log
+class ReplayResult:
+    def __init__(self):
+        self.emitted = []   # (time, frame) send by the replayed master
+        self.recorded = []  # (time, frame) recorded
+        self.duration = 0.0 # recorded time span in seconds
+
+    # true when the replayed master sends the same frames in the same order
+    def matches(self):
+        return [f for _, f in self.emitted] == [f for _, f in self.recorded]
+
+    # unified diff of recorded and emitted frames in hex
+    def diff(self):
+        recorded = [f.hex() for _, f in self.recorded]
+        emitted = [f.hex() for _, f in self.emitted]
+        return list(difflib.unified_diff(recorded, emitted, "recorded", "replayed", lineterm=""))
+
+
+# replay log through master on a virtual clock
+# master: configured TWCMaster created with a VirtualClock, a new master with default config when None
+def replay(path, master = None):
+    result = ReplayResult()
+    records = list(readRecords(path))
+    if not records:
+        return result
+    start = records[0][0]
+    result.duration = records[-1][0] - start
+
+    if master == None:
+        master = twcmaster.TWCMaster(clock=twcmaster.VirtualClock(start))
+    clock = master.clock
+    clock.set(start)
+
+    # send slots are released at the recorded send timer times,
+    # logs without send timer records get timers on the virtual clock
+    if any(recordType == SENDTIMER for _, recordType, _ in records):
+        master.setSendTimerCallback(lambda delay, func: None)
+    else:
+        master.setSendTimerCallback(clock.callLater)
+    master.setSendDataCallback(lambda data: result.emitted.append((clock(), bytes(data))))
+
+    for t, recordType, data in records:
+        clock.runUntil(t)
+        if recordType == RECEIVED:
+            master.dataReceived(data)
+        elif recordType == SENT:
+            result.recorded.append((t, data))
+        elif recordType == POWER:
+            master.setActualPower(unpackValues(data))
+        elif recordType == VOLTS:
+            master.setActualVolts(unpackValues(data))
+        elif recordType == SCHEDULEDAMPS:
+            master.setScheduledMaxAmps(unpackValues(data)[0])
+        elif recordType == HEARTBEAT:
+            master.handleHeartBeat()
+        elif recordType == HANDLERECEIVED:
+            master.handleReceived()
+        elif recordType == SENDTIMER:
+            master.onSendTimer()
+        elif recordType == SENDQUEUE:
+            master.processSendQueue()
+        elif recordType == UPDATE:
+            master.update()
+        elif recordType == STOPSENDING:
+            master.stopSending()
+    # stop at the last record, frames still queued were not send by the recorded master
+    clock.runUntil(records[-1][0])
+    return result
+
+
+# replay log: python3 twcrecord.py log [max network current] [max current all TWC's] [max current per TWC]
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("usage: python3 twcrecord.py log [totalmax] [twctotalmax] [twcmax]")
+        sys.exit(1)
+    logging.basicConfig(level=logging.WARNING)
+    master = twcmaster.TWCMaster(clock=twcmaster.VirtualClock())
+    amps = [float(a) for a in sys.argv[2:5]]
+    amps += [twcmaster.TotalMaxAmps, twcmaster.TWCsTotalMaxAmps, twcmaster.TWCMaxAmps][len(amps):]
+    master.setConfig(amps[0], amps[1], amps[2])
+    t = time.perf_counter()
+    result = replay(sys.argv[1], master)
+    t = time.perf_counter() - t
+    print("replayed %.0f s in %.3f s: %d frames recorded, %d frames send" % (result.duration, t, len(result.recorded), len(result.emitted)))
+    for line in result.diff():
+        print(line)
+    sys.exit(0 if result.matches() else 1)
@@ -0,0 +1,173 @@
+#
+# TWC time series
+# Power, amps and energy samples per TWC in a fixed size ring buffer file per TWC, memory mapped,
+# samples are written in place, the file never grows. Queries are downsampled to buckets
+#
+# file = header, capacity records: time (double), power (float), amps (float), energy Wh since link (double)
+#
+import os
+import mmap
+import struct
+import logging
+
+SERIESCAPACITY = 172800     # samples per TWC, 2 days of one sample per second
+SERIESFLUSH = 60            # seconds between flushes of the memory mapped files
+
+SERIESMAGIC = b"TWCT"
+SERIESVERSION = 1
+SERIESHEADER = struct.Struct("<4sBIQ")      # magic, version, capacity, samples appended
+SERIESRECORD = struct.Struct("<dffd")       # time, power, amps, energy
+
+
+# Ring buffer file for the samples of one TWC
+class TimeSeries:
+    def __init__(self, path, capacity = SERIESCAPACITY):
+        self.path = path
+        size = SERIESHEADER.size + capacity * SERIESRECORD.size
+        exists = os.path.exists(path)
+        self.file = open(path, "r+b" if exists else "w+b")
+        if os.path.getsize(path) != size:
+            self.file.truncate(size)
+        self.map = mmap.mmap(self.file.fileno(), size)
+        magic, version, fileCapacity, count = SERIESHEADER.unpack_from(self.map, 0)
+        if (magic != SERIESMAGIC) or (version != SERIESVERSION) or (fileCapacity != capacity):
+            if exists:
+                logging.warn("Time series %s not compatible, cleared", path)
+            count = 0
+            SERIESHEADER.pack_into(self.map, 0, SERIESMAGIC, SERIESVERSION, capacity, count)
+        self.capacity = capacity
+        self.count = count          # samples appended, the last capacity samples are kept
+
+    # number of samples kept
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    # add sample, times must not decrease
+    def append(self, t, power, amps, energy):
+        SERIESRECORD.pack_into(self.map, SERIESHEADER.size + (self.count % self.capacity) * SERIESRECORD.size, t, power, amps, energy)
+        self.count += 1
+        SERIESHEADER.pack_into(self.map, 0, SERIESMAGIC, SERIESVERSION, self.capacity, self.count)
+
+    # sample i, 0 is the oldest: (time, power, amps, energy)
+    def __getitem__(self, i):
+        first = self.count - len(self)
+        return SERIESRECORD.unpack_from(self.map, SERIESHEADER.size + ((first + i) % self.capacity) * SERIESRECORD.size)
+
+    # time of sample i
+    def time(self, i):
+        first = self.count - len(self)
+        return struct.unpack_from("<d", self.map, SERIESHEADER.size + ((first + i) % self.capacity) * SERIESRECORD.size)[0]
+
+    # index of the first sample at or after time t
+    def find(self, t):
+        lo = 0
+        hi = len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.time(mid) < t:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    # samples from start up to end
+    def samples(self, start, end):
+        for i in range(self.find(start), self.find(end)):
+            yield self[i]
+
+    # energy in Wh between start and end, from the energy counter of the samples, same as the sum of the query() buckets
+    def energy(self, start, end):
+        first = self.find(start)
+        wh = 0.0
+        previous = self[first - 1][3] if first > 0 else None
+        for i in range(first, self.find(end)):
+            energy = self[i][3]
+            if previous != None:
+                # the energy counter restarts when the TWC links again
+                wh += energy - previous if energy >= previous else energy
+            previous = energy
+        return wh
+
+    # downsampled samples: [(bucket start, mean power, mean amps, max amps, energy Wh)] per step seconds, empty buckets skipped
+    # the energy of a bucket includes the step from the sample before it
+    def query(self, start, end, step):
+        result = []
+        bucket = None
+        first = self.find(start)
+        previous = self[first - 1][3] if first > 0 else None
+        for i in range(first, self.find(end)):
+            t, power, amps, energy = self[i]
+            b = start + ((t - start) // step) * step
+            if b != bucket:
+                if bucket != None:
+                    result.append((bucket, sumPower / n, sumAmps / n, maxAmps, wh))
+                bucket = b
+                n = 0
+                sumPower = sumAmps = maxAmps = wh = 0.0
+            n += 1
+            sumPower += power
+            sumAmps += amps
+            maxAmps = max(maxAmps, amps)
+            if previous != None:
+                # the energy counter restarts when the TWC links again
+                wh += energy - previous if energy >= previous else energy
+            previous = energy
+        if bucket != None:
+            result.append((bucket, sumPower / n, sumAmps / n, maxAmps, wh))
+        return result
+
+    # write changed pages to disk
+    def flush(self):
+        self.map.flush()
+
+    def close(self):
+        self.map.flush()
+        self.map.close()
+        self.file.close()
+
+
+# Time series per TWC in folder, files twc-<id>.bin, set with TWCMaster.setSeries()
+class SeriesStore:
+    def __init__(self, folder, capacity = SERIESCAPACITY):
+        self.folder = folder
+        self.capacity = capacity
+        self.series = {}            # TimeSeries per twcId
+        self.nextFlush = None
+
+    # time series of a TWC, created when new
+    def get(self, twcId):
+        series = self.series.get(twcId)
+        if series == None:
+            series = TimeSeries(os.path.join(self.folder, "twc-%04x.bin" % twcId), self.capacity)
+            self.series[twcId] = series
+        return series
+
+    # add a sample for each TWC of master, called every heartbeat
+    def sample(self, master, now):
+        for twc in master.twcs.values():
+            self.get(twc.twcId).append(now, twc.actualPower, twc.actualAmps, twc.energyWh)
+        if self.nextFlush == None:
+            self.nextFlush = now + SERIESFLUSH
+        elif now >= self.nextFlush:
+            self.nextFlush = now + SERIESFLUSH
+            self.flush()
+
+    # twcIds with a time series file in folder
+    def twcIds(self):
+        ids = []
+        for name in os.listdir(self.folder):
+            if name.startswith("twc-") and name.endswith(".bin"):
+                try:
+                    ids.append(int(name[4:-4], 16))
+                except ValueError:
+                    pass
+        return sorted(ids)
+
+    def flush(self):
+        for series in self.series.values():
+            series.flush()
+
+    def close(self):
+        for series in self.series.values():
+            series.close()
+        self.series = {}
@@ -0,0 +1,306 @@
+#
+# TWC charging sessions
+# Sessions per TWC from plug-in to unplug, detected from the TWC states every heartbeat, set with TWCMaster.setSessions()
+# events: plugin, start (car draws current), taper (car draws less than offered), stop (car stopped drawing current), end (unplugged)
+# ended sessions are appended to a file of fixed size records, indexed by TWC and by day for lookups without a scan
+# open sessions are saved to a second file on stop and every STATESAVEINTERVAL, a restart continues them
+#
+# file = header, records: twcId, starts, times of plugin/start/taper/stop/end, energy Wh, peak amps, mean amps,
+#        charging seconds, throttled seconds, ramp seconds
+# open file = header with the save time, records as above each followed by charging, last energy and last update
+#
+import os
+import struct
+import logging
+import datetime
+
+import twcmaster
+
+SESSIONFILE = "twcsessions.bin"
+OPENSESSIONFILE = "twcsessions.open"
+CHARGINGAMPS = 0.5          # min actual amps for charging
+TAPERDELAY = 30             # seconds after a set amps change before a car drawing less than offered is tapering
+MAXSAMPLEGAP = 10           # max seconds counted between two updates, longer gaps are not counted
+
+SESSIONMAGIC = b"TWCE"
+SESSIONVERSION = 1
+SESSIONHEADER = struct.Struct("<4sB")               # magic, version
+SESSIONRECORD = struct.Struct("<HHddddddfffff")     # twcId, starts, plugin, start, taper, stop, end, energy, peak amps,
+                                                    # mean amps, charging seconds, throttled seconds, ramp seconds
+OPENMAGIC = b"TWCO"
+OPENHEADER = struct.Struct("<4sBd")                 # magic, version, save time
+OPENTRACKING = struct.Struct("<Bdd")                # charging, last energy (-1: none), last update
+
+
+# charging session of one TWC, times are 0 when the event did not happen
+class Session:
+    FIELDS = ("twcId", "starts", "plugin", "start", "taper", "stop", "end", "energyWh", "peakAmps", "meanAmps",
+              "chargingSeconds", "throttledSeconds", "rampSeconds")
+
+    def __init__(self, twcId, plugin):
+        self.twcId = twcId
+        self.starts = 0                 # number of times charging started
+        self.plugin = plugin            # time plugged in
+        self.start = 0.0                # first time charging
+        self.taper = 0.0                # first time the car drew less than offered
+        self.stop = 0.0                 # last time charging stopped
+        self.end = 0.0                  # time unplugged
+        self.energyWh = 0.0
+        self.peakAmps = 0.0
+        self.meanAmps = 0.0             # mean while charging
+        self.chargingSeconds = 0.0
+        self.throttledSeconds = 0.0     # charging with desired amps below the TWC max, limited by calcDesiredAmps
+        self.rampSeconds = 0.0          # charging with set amps below desired amps, waiting for the increase delay
+        # tracking, not saved
+        self.charging = False
+        self.lastEnergy = None
+        self.lastUpdate = plugin
+
+    # day of the plugin time
+    def day(self):
+        return datetime.date.fromtimestamp(self.plugin)
+
+    def pack(self):
+        return SESSIONRECORD.pack(*[getattr(self, name) for name in Session.FIELDS])
+
+    @staticmethod
+    def unpack(data, offset = 0):
+        values = SESSIONRECORD.unpack_from(data, offset)
+        session = Session(values[0], values[2])
+        for name, value in zip(Session.FIELDS, values):
+            setattr(session, name, value)
+        return session
+
+    def asDict(self):
+        return dict((name, getattr(self, name)) for name in Session.FIELDS)
+
+    # update with the TWC data of this heartbeat
+    def update(self, twc, now):
+        dt = now - self.lastUpdate
+        if dt > MAXSAMPLEGAP:
+            dt = 0.0
+        self.lastUpdate = now
+
+        # energy counter of the twc, restarts when the TWC links again
+        energy = twc.energyWh
+        if self.lastEnergy != None:
+            self.energyWh += energy - self.lastEnergy if energy >= self.lastEnergy else energy
+        self.lastEnergy = energy
+
+        charging = twc.actualAmps > CHARGINGAMPS
+        if charging and not self.charging:
+            self.starts += 1
+            if self.start == 0:
+                self.start = now
+            logging.info("TWC(%04x) session start charging %.2f", self.twcId, twc.actualAmps)
+        elif self.charging and not charging:
+            self.stop = now
+            logging.info("TWC(%04x) session stop charging, %.0f Wh", self.twcId, self.energyWh)
+        self.charging = charging
+        if not charging:
+            return
+
+        # amps
+        self.peakAmps = max(self.peakAmps, twc.actualAmps)
+        if dt > 0:
+            self.meanAmps += (twc.actualAmps - self.meanAmps) * dt / (self.chargingSeconds + dt)
+            self.chargingSeconds += dt
+
+        # tapering: the car draws less than offered while the offer did not change
+        tapering = ((twc.actualAmps + twcmaster.TAPERMARGIN / 2 < twc.availableAmps)
+                    and (twc.lastAmpsChanged < now - TAPERDELAY))
+        if tapering and self.taper == 0:
+            self.taper = now
+            logging.info("TWC(%04x) session taper at %.2f of %.2f", self.twcId, twc.actualAmps, twc.availableAmps)
+
+        # throttled and ramping, not counted while the car limits the current
+        if not tapering:
+            limit = min(twc.maxAmps, twc.master.twcMaxAmps)
+            if twc.desiredAmps < int(limit):
+                self.throttledSeconds += dt
+            if twc.setAmps < twc.desiredAmps:
+                self.rampSeconds += dt
+
+
+# ended sessions in a file, indexed by TWC and by day
+class SessionStore:
+    def __init__(self, path):
+        self.path = path
+        self.sessions = []
+        self.twcIndex = {}          # session indexes per twcId
+        self.dayIndex = {}          # session indexes per day (datetime.date)
+        self.file = None
+        self.load()
+
+    # read the sessions file, a partly written record at the end is removed
+    def load(self):
+        data = b""
+        if os.path.exists(self.path):
+            with open(self.path, "rb") as f:
+                data = f.read()
+        if (len(data) < SESSIONHEADER.size) or (SESSIONHEADER.unpack_from(data, 0) != (SESSIONMAGIC, SESSIONVERSION)):
+            if data:
+                logging.warn("Sessions file %s not compatible, started new file", self.path)
+            self.file = open(self.path, "wb")
+            self.file.write(SESSIONHEADER.pack(SESSIONMAGIC, SESSIONVERSION))
+            self.file.flush()
+            return
+        count = (len(data) - SESSIONHEADER.size) // SESSIONRECORD.size
+        for i in range(count):
+            self.index(Session.unpack(data, SESSIONHEADER.size + i * SESSIONRECORD.size))
+        self.file = open(self.path, "r+b")
+        self.file.truncate(SESSIONHEADER.size + count * SESSIONRECORD.size)
+        self.file.seek(0, os.SEEK_END)
+
+    def index(self, session):
+        i = len(self.sessions)
+        self.sessions.append(session)
+        self.twcIndex.setdefault(session.twcId, []).append(i)
+        self.dayIndex.setdefault(session.day(), []).append(i)
+
+    # append an ended session
+    def add(self, session):
+        self.index(session)
+        self.file.write(session.pack())
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    # sessions of a TWC
+    def byTWC(self, twcId):
+        return [self.sessions[i] for i in self.twcIndex.get(twcId, ())]
+
+    # sessions plugged in on day (datetime.date)
+    def byDay(self, day):
+        return [self.sessions[i] for i in self.dayIndex.get(day, ())]
+
+    def twcIds(self):
+        return sorted(self.twcIndex)
+
+    def days(self):
+        return sorted(self.dayIndex)
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+
+# totals of sessions: count, energy, charging, throttled and ramp seconds, peak amps and mean amps weighted by charging time
+def summary(sessions):
+    result = {"sessions": 0, "energyWh": 0.0, "chargingSeconds": 0.0, "throttledSeconds": 0.0, "rampSeconds": 0.0,
+              "peakAmps": 0.0, "meanAmps": 0.0}
+    for s in sessions:
+        result["sessions"] += 1
+        result["energyWh"] += s.energyWh
+        result["chargingSeconds"] += s.chargingSeconds
+        result["throttledSeconds"] += s.throttledSeconds
+        result["rampSeconds"] += s.rampSeconds
+        result["peakAmps"] = max(result["peakAmps"], s.peakAmps)
+        result["meanAmps"] += s.meanAmps * s.chargingSeconds
+    if result["chargingSeconds"] > 0:
+        result["meanAmps"] /= result["chargingSeconds"]
+    return result
+
+
+# open sessions per TWC of a master, ended sessions go to store
+# with a path the open sessions are saved on close and every STATESAVEINTERVAL, load continues them after a restart
+class SessionTracker:
+    def __init__(self, store, path = None):
+        self.store = store
+        self.path = path            # file for the open sessions, None: open sessions end on close
+        self.open = {}              # open session per twcId
+        self.nextSave = 0.0         # time of the next save of the open sessions
+
+    # plugged in: a car is connected in any state except NONE and ERROR, or current is drawn
+    @staticmethod
+    def isPlugged(twc):
+        return (twc.state not in (twcmaster.TWC.NONE, twcmaster.TWC.ERROR)) or (twc.actualAmps > CHARGINGAMPS)
+
+    # update the sessions with the TWCs of master, called every heartbeat
+    def update(self, master, now):
+        twcs = master.twcs
+        for twc in twcs.values():
+            session = self.open.get(twc.twcId)
+            if self.isPlugged(twc):
+                if session == None:
+                    session = Session(twc.twcId, now)
+                    session.lastEnergy = twc.energyWh
+                    self.open[twc.twcId] = session
+                    logging.info("TWC(%04x) session plugin", twc.twcId)
+                session.update(twc, now)
+            elif session:
+                session.update(twc, now)
+                self.endSession(session, now)
+        # TWCs removed from the master
+        for twcId in [twcId for twcId in self.open if twcId not in twcs]:
+            self.endSession(self.open[twcId], now)
+        # open sessions saved with the master state
+        if self.path and (now >= self.nextSave):
+            self.nextSave = now + twcmaster.STATESAVEINTERVAL
+            self.save(now)
+
+    def endSession(self, session, now):
+        del self.open[session.twcId]
+        if session.charging:
+            session.stop = now
+        session.end = now
+        logging.info("TWC(%04x) session end, %.0f Wh, %.0f seconds charging", session.twcId, session.energyWh, session.chargingSeconds)
+        self.store.add(session)
+
+    # save the open sessions, the file is removed when no session is open
+    def save(self, now):
+        if not self.open:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            return True
+        data = bytearray(OPENHEADER.pack(OPENMAGIC, SESSIONVERSION, now))
+        for session in self.open.values():
+            data += session.pack()
+            data += OPENTRACKING.pack(session.charging, -1.0 if session.lastEnergy == None else session.lastEnergy, session.lastUpdate)
+        tmp = self.path + ".tmp"
+        try:
+            with open(tmp, "wb") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+        except OSError as e:
+            logging.error("Save open sessions to %s failed: %s", self.path, e)
+            return False
+        return True
+
+    # continue the sessions saved by save, when not older than STATEMAXAGE, like the TWCs of the master state
+    # older sessions end at the save time
+    def load(self, now):
+        if not (self.path and os.path.exists(self.path)):
+            return False
+        with open(self.path, "rb") as f:
+            data = f.read()
+        os.remove(self.path)
+        size = SESSIONRECORD.size + OPENTRACKING.size
+        if (len(data) < OPENHEADER.size) or (OPENHEADER.unpack_from(data, 0)[:2] != (OPENMAGIC, SESSIONVERSION)) or ((len(data) - OPENHEADER.size) % size):
+            logging.warn("Open sessions file %s not compatible", self.path)
+            return False
+        saved = OPENHEADER.unpack_from(data, 0)[2]
+        resume = (saved >= now - twcmaster.STATEMAXAGE) and (saved <= now)
+        for offset in range(OPENHEADER.size, len(data), size):
+            session = Session.unpack(data, offset)
+            charging, lastEnergy, lastUpdate = OPENTRACKING.unpack_from(data, offset + SESSIONRECORD.size)
+            session.charging = bool(charging)
+            session.lastEnergy = None if lastEnergy < 0 else lastEnergy
+            session.lastUpdate = lastUpdate
+            self.open[session.twcId] = session
+            if resume:
+                logging.info("TWC(%04x) session continued, %.0f Wh", session.twcId, session.energyWh)
+            else:
+                self.endSession(session, min(saved, now))
+        return resume
+
+    # on stop: save the open sessions for the next start, or end them without a path
+    def close(self, now):
+        if self.path:
+            self.save(now)
+        else:
+            for session in list(self.open.values()):
+                self.endSession(session, now)
+        self.store.close()
@@ -0,0 +1,287 @@
+#
+# TWC slave simulator
+# Simulated version 1 and 2 TWC slaves on a virtual RS485 bus, driven by a TWCMaster on a virtual clock
+# for load and scale tests without wall connectors: linkready, heartbeats with state changes and kwh/volts,
+# with optional line noise, collisions and lost frames
+#
+import time
+import random
+import logging
+import twcmaster
+from twcmaster import TWC
+
+SLAVESIGN = 0x77            # sign of simulated slaves
+REPLYDELAY = 0.02           # seconds between master message and slave reply
+LINKREADYDELAY = 0.15       # max random delay of linkready replies, slaves choose a random slot
+LINKREADYCHANCE = 0.3       # chance per second a slave without master sends a linkready by itself
+FRAMETIME = 0.02            # seconds a frame is on the bus, 9600 baud
+SLAVETIMEOUT = 10           # slave stops charging when it has no heartbeat from master for this many seconds
+VOLTS = 230.0               # volts per phase
+
+
+# Simulated TWC slave, charging a car on phases (0..2)
+class SimSlave:
+    def __init__(self, twcId, version = 2, maxAmps = 32.0, carMaxAmps = 16.0, rampRate = 4.0, phases = twcmaster.ALLPHASES):
+        self.twcId = twcId
+        self.phases = phases
+        self.version = version
+        self.maxAmps = maxAmps
+        self.carMaxAmps = carMaxAmps    # max current the car draws, 0 when no car is plugged in
+        self.rampRate = rampRate        # amps per second the car changes its current
+        self.masterId = None
+        self.state = TWC.NONE
+        self.availableAmps = 0.0        # max current set by master
+        self.actualAmps = 0.0
+        self.kwh = 0.0
+        self.lastHeartBeat = None       # time of last heartbeat from master
+        self.lastUpdate = None
+
+    # create frame: pad message to slave message length, add checksum, escape and frame
+    def createFrame(self, msg):
+        msg = bytearray(msg)
+        msg.extend(bytes((13 if self.version == 1 else 15) - len(msg)))
+        return twcmaster.encodeFrame(msg)
+
+    # linkready: FDE2 slaveid sign maxamps*100
+    def linkReadyFrame(self):
+        amps = int(self.maxAmps * 100)
+        return self.createFrame([0xfd, 0xe2, self.twcId >> 8, self.twcId & 0xff, SLAVESIGN, amps >> 8, amps & 0xff])
+
+    # heartbeat: FDE0 slaveid masterid state maxamps*100 actualamps*100
+    def heartBeatFrame(self):
+        available = int(self.availableAmps * 100)
+        actual = int(self.actualAmps * 100)
+        return self.createFrame([0xfd, 0xe0, self.twcId >> 8, self.twcId & 0xff, self.masterId >> 8, self.masterId & 0xff,
+                                 self.state, available >> 8, available & 0xff, actual >> 8, actual & 0xff])
+
+    # kwh/volts: FDEB slaveid kwh(4) v1 v2 v3
+    def kwhVoltsFrame(self):
+        kwh = int(self.kwh)
+        volts = int(VOLTS)
+        return self.createFrame([0xfd, 0xeb, self.twcId >> 8, self.twcId & 0xff,
+                                 (kwh >> 24) & 0xff, (kwh >> 16) & 0xff, (kwh >> 8) & 0xff, kwh & 0xff,
+                                 volts >> 8, volts & 0xff, volts >> 8, volts & 0xff, volts >> 8, volts & 0xff])
+
+    # update charging: state changes and ramp actual amps to the current the car may use
+    def updateCar(self, now):
+        dt = 0.0 if self.lastUpdate == None else now - self.lastUpdate
+        self.lastUpdate = now
+        self.kwh += self.actualAmps * VOLTS * len(self.phases) * dt / 3600000.0
+        if (self.lastHeartBeat != None) and (self.lastHeartBeat < now - SLAVETIMEOUT):
+            self.availableAmps = 0.0
+        if self.carMaxAmps <= 0:
+            self.state = TWC.NONE
+            target = 0.0
+        elif self.availableAmps >= twcmaster.TWCMINAMPS:
+            if self.state in (TWC.NONE, TWC.READYTOCHARGE):
+                self.state = TWC.STARTCHARGING
+            elif self.state == TWC.STARTCHARGING:
+                self.state = TWC.CHARGING
+            target = min(self.availableAmps, self.carMaxAmps)
+        else:
+            self.state = TWC.READYTOCHARGE
+            target = 0.0
+        # decrease immediately, increase with ramp rate
+        if target < self.actualAmps:
+            self.actualAmps = target
+        else:
+            self.actualAmps = min(target, self.actualAmps + self.rampRate * dt)
+
+    # is the slave linked: receiving heartbeats from master
+    def isLinked(self, now):
+        return (self.lastHeartBeat != None) and (self.lastHeartBeat >= now - SLAVETIMEOUT)
+
+    # handle unescaped message from master, returns reply frame or None
+    def handleMsg(self, msg, now):
+        if len(msg) < 6:
+            return None
+        msgtype = (msg[0] << 8) + msg[1]
+        sender = (msg[2] << 8) + msg[3]
+        receiver = (msg[4] << 8) + msg[5]
+        if msgtype in (0xfce1, 0xfbe2):
+            # linkready from master, only answered when not linked
+            self.masterId = sender
+            if self.isLinked(now):
+                return None
+            return self.linkReadyFrame()
+        if receiver != self.twcId:
+            return None
+        self.masterId = sender
+        if msgtype == 0xfbe0:
+            # heartbeat from master: 05/09 sets max amps
+            self.lastHeartBeat = now
+            if msg[6] in (0x05, 0x09):
+                self.availableAmps = ((msg[7] << 8) + msg[8]) / 100.0
+            self.updateCar(now)
+            return self.heartBeatFrame()
+        if msgtype == 0xfbeb:
+            return self.kwhVoltsFrame()
+        return None
+
+
+# Virtual RS485 bus between a master and simulated slaves
+class VirtualBus:
+    def __init__(self, master, clock, seed = 1, noiseRate = 0.0, lossRate = 0.0, collisionRate = 0.0):
+        self.master = master
+        self.clock = clock
+        self.slaves = []
+        self.decoder = twcmaster.FrameDecoder()
+        self.random = random.Random(seed)
+        self.noiseRate = noiseRate          # chance a reply is damaged or followed by line noise
+        self.lossRate = lossRate            # chance a reply is lost
+        self.collisionRate = collisionRate  # chance a reply collides with a frame from outside
+        # counters
+        self.framesFromMaster = 0
+        self.framesToMaster = 0
+        self.framesLost = 0
+        self.collisions = 0
+        self.onBus = []                     # (start time, frame) of slave frames on the bus
+        master.setClock(clock)
+        master.setSendTimerCallback(clock.callLater)
+        master.setSendDataCallback(self.send)
+
+    def addSlave(self, slave):
+        self.slaves.append(slave)
+
+    # data send by master: deliver to the slaves and schedule the replies
+    def send(self, data):
+        now = self.clock()
+        self.decoder.feed(data)
+        replies = []
+        for msg in self.decoder.frames():
+            if len(msg) < 2:
+                continue
+            self.framesFromMaster += 1
+            broadcast = ((msg[0] << 8) + msg[1]) in (0xfce1, 0xfbe2)
+            for slave in self.slaves:
+                reply = slave.handleMsg(msg, now)
+                if reply:
+                    # slaves choose a random slot for linkready replies
+                    delay = REPLYDELAY + (self.random.uniform(0, LINKREADYDELAY) if broadcast else 0.0)
+                    replies.append((delay, reply))
+        for delay, reply in replies:
+            self.transmit(delay, reply)
+
+    # slave frame on the bus after delay, frames that overlap on the bus collide and arrive as one damaged frame
+    def transmit(self, delay, frame):
+        now = self.clock()
+        start = now + delay
+        self.onBus = [(s, f) for s, f in self.onBus if s + FRAMETIME > now]
+        for s, other in self.onBus:
+            if abs(s - start) < FRAMETIME:
+                self.collisions += 1
+                self.collide(other, frame)
+                return
+        data = bytearray(frame)
+        if self.random.random() < self.collisionRate:
+            self.collisions += 1
+            self.collide(data, bytes(self.random.randrange(256) for _ in range(8)))
+        if self.random.random() < self.lossRate:
+            self.framesLost += 1
+            return
+        if self.random.random() < self.noiseRate:
+            data = self.addNoise(data)
+        self.onBus.append((start, data))
+        self.framesToMaster += 1
+        self.clock.callLater(delay, lambda: self.master.dataReceived(data))
+
+    # two frames on the bus at the same time: frame is changed in place
+    def collide(self, frame, other):
+        if len(other) > len(frame):
+            frame.extend(bytes(len(other) - len(frame)))
+        for i in range(len(other)):
+            frame[i] ^= other[i]
+
+    # flip a bit or add random bytes
+    def addNoise(self, frame):
+        data = bytearray(frame)
+        if self.random.random() < 0.5:
+            data[self.random.randrange(len(data))] ^= 1 << self.random.randrange(8)
+        else:
+            data.extend(self.random.randrange(256) for _ in range(self.random.randrange(1, 16)))
+        return data
+
+
+# Simulation: master, bus and slaves on a virtual clock, with a P1 meter reading the household load
+class Simulation:
+    def __init__(self, slaves, seed = 1, noiseRate = 0.0, lossRate = 0.0, collisionRate = 0.0, otherLoad = None):
+        self.clock = twcmaster.VirtualClock(1000000.0)
+        self.master = twcmaster.TWCMaster(clock=self.clock)
+        self.master.setMaxSlaves(max(len(slaves), twcmaster.MAXSLAVES))
+        self.bus = VirtualBus(self.master, self.clock, seed, noiseRate, lossRate, collisionRate)
+        for slave in slaves:
+            self.bus.addSlave(slave)
+        # power per phase in watts used by other devices: function(time since start)
+        self.otherLoad = otherLoad if otherLoad else (lambda t: [1000.0, 1000.0, 1000.0])
+        self.start = self.clock()
+        self.tickTimes = []                 # wall time in seconds per master tick
+        self.trace = []                     # (time since start, total slave amps) per P1 reading
+
+    # P1 reading: other devices plus the slaves
+    def readP1(self, now):
+        power = list(self.otherLoad(now - self.start))
+        for slave in self.bus.slaves:
+            slave.updateCar(now)
+            for i in slave.phases:
+                if i < len(power):
+                    power[i] += slave.actualAmps * VOLTS
+        return power
+
+    # total current of all slaves
+    def totalAmps(self):
+        return sum(slave.actualAmps for slave in self.bus.slaves)
+
+    # run for seconds of simulated time, with a P1 reading every p1Interval and a master heartbeat every second
+    def run(self, seconds, p1Interval = 1.0):
+        clock = self.clock
+        end = clock() + seconds
+        nextP1 = clock()
+        nextHeartBeat = clock()
+        while clock() < end:
+            now = min(nextP1, nextHeartBeat)
+            clock.runUntil(now)
+            t = time.perf_counter()
+            if now >= nextP1:
+                self.master.setActualVolts([VOLTS, VOLTS, VOLTS])
+                self.master.setActualPower(self.readP1(now))
+                self.trace.append((now - self.start, self.totalAmps()))
+                nextP1 += p1Interval
+            if now >= nextHeartBeat:
+                self.master.handleHeartBeat()
+                nextHeartBeat += 1.0
+                # slaves without master send linkready by themselves
+                for slave in self.bus.slaves:
+                    if (not slave.isLinked(now)) and (self.bus.random.random() < LINKREADYCHANCE):
+                        self.bus.transmit(self.bus.random.uniform(0, 1.0), slave.linkReadyFrame())
+            self.tickTimes.append(time.perf_counter() - t)
+        clock.runUntil(end)
+
+    # seconds after time t until the total slave current stays within tolerance amps of its final value
+    def convergenceTime(self, t, tolerance = 1.0):
+        trace = [(s, amps) for s, amps in self.trace if s >= t]
+        if not trace:
+            return None
+        final = trace[-1][1]
+        settled = trace[-1][0]
+        for s, amps in reversed(trace):
+            if abs(amps - final) > tolerance:
+                break
+            settled = s
+        return settled - t
+
+
+# run a fleet: python3 twcsim.py [slaves] [seconds]
+if __name__ == "__main__":
+    import sys
+    logging.basicConfig(level=logging.WARNING)
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 3600
+    slaves = [SimSlave(0x1000 + i, version=1 + (i % 2)) for i in range(count)]
+    sim = Simulation(slaves, noiseRate=0.01, lossRate=0.01)
+    sim.master.setConfig(25.0 + 16.0 * count, 16.0 * count, 16.0)
+    sim.master.setScheduledMaxAmps(16.0 * count)
+    t = time.perf_counter()
+    sim.run(seconds)
+    t = time.perf_counter() - t
+    print("%d slaves, %.0f s simulated in %.2f s, %d linked, %.1f A charging" % (count, seconds, t, len(sim.master.twcs), sim.totalAmps()))
+    print("frames: %d from master, %d to master, %d lost, %d collisions" % (sim.bus.framesFromMaster, sim.bus.framesToMaster, sim.bus.framesLost, sim.bus.collisions))